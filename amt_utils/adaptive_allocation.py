@@ -0,0 +1,148 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import fake_mturk
+import process_hits
+from throttling import TokenBucket, call_with_retry, is_throttling_error
+
+"""
+Adaptive assignment allocation: pages are posted with few assignments, and only HITs with contested boxes are
+extended, one assignment at a time up to a cap. Includes a simulator, with fake_mturk's synthetic workers answering
+the HITs, for comparing the cost and accuracy of allocation policies offline.
+"""
+
+def contested_hits(consensus_df, min_agreement=0.6, min_votes=2, max_unsettled_share=0.0):
+    """
+    Finds HITs with too many boxes that haven't settled.
+    A box is settled when it isn't tied, has at least min_votes votes and min_agreement of them agree.
+    :param consensus_df: see process_hits.make_consensus_df
+    :param max_unsettled_share: HITs with a larger share of unsettled boxes are contested. With the default, one
+    unsettled box is enough.
+    :return: set of hit ids
+    """
+    unsettled = consensus_df['tie'].values | (consensus_df['agreement'].values < min_agreement) | \
+        (consensus_df['vote_count'].values < min_votes)
+    hit_codes, hit_ids = pd.factorize(np.asarray(consensus_df['hit_id'], dtype=object))
+    unsettled_share = np.bincount(hit_codes, weights=unsettled, minlength=len(hit_ids)) / \
+        np.bincount(hit_codes, minlength=len(hit_ids)).astype(float)
+    return set(np.asarray(hit_ids)[unsettled_share > max_unsettled_share])
+
+
+def plan_extensions(assignments_by_hit, max_assignments=5, min_agreement=0.6, min_votes=2, max_unsettled_share=0.0,
+                    increment=1, no_consensus_flag='No Consensus', consensus_method='majority'):
+    """
+    Decides which HITs need more assignments, from the assignments submitted so far.
+    :param assignments_by_hit: hit_id: [boto assignment] dict, as returned by process_hits.get_assignments
+    :param max_assignments: most assignments any HIT is extended to
+    :param min_agreement, min_votes, max_unsettled_share: see contested_hits
+    :param increment: assignments added to each contested HIT per round
+    :param consensus_method: see process_hits.make_consensus_df
+    :return: hit_id: assignments to add dict
+    """
+    results_df = process_hits.make_results_df_from_assignments(assignments_by_hit)
+    if not len(results_df):
+        return {}
+    consensus_df = process_hits.make_consensus_df(results_df, no_consensus_flag, method=consensus_method)
+    extensions = {}
+    for hit_id in contested_hits(consensus_df, min_agreement, min_votes, max_unsettled_share):
+        room = max_assignments - len(assignments_by_hit[hit_id])
+        if room > 0:
+            extensions[hit_id] = min(increment, room)
+    return extensions
+
+
+def extend_hits(mturk_connection, extensions, max_workers=1, max_per_second=None, max_retries=3):
+    """
+    Adds assignments to HITs, optionally from a pool of threads sharing a rate limit.
+    Only throttled requests are retried: extend_hit isn't idempotent, so retrying one that timed out or failed
+    server-side could add the increment twice and buy extra assignments.
+    :param extensions: hit_id: assignments to add dict, see plan_extensions
+    :return: hit_id: assignments added dict, holding the exception instead for HITs that could not be extended
+    """
+    rate_limiter = TokenBucket(max_per_second) if max_per_second else None
+
+    def extend_hit(extension):
+        hit_id, increment = extension
+        try:
+            call_with_retry(mturk_connection.extend_hit, (hit_id,), {'assignments_increment': increment},
+                            max_retries=max_retries, rate_limiter=rate_limiter, is_retryable=is_throttling_error)
+            return hit_id, increment
+        except Exception as e:
+            return hit_id, e
+
+    return OrderedDict(process_hits.map_with_pool(extend_hit, sorted(extensions.items()), max_workers))
+
+
+def run_adaptive_round(mturk_connection, max_assignments=5, min_agreement=0.6, min_votes=2, max_unsettled_share=0.0,
+                       increment=1, consensus_method='majority', **harvest_params):
+    """
+    Harvests the reviewable HITs and extends the contested ones. Extended HITs go back to being assignable, so
+    calling this again once they're reviewable continues until every HIT is settled or at the cap.
+    :param mturk_connection: active mturk connection established by user in the nb.
+    :param max_assignments, min_agreement, min_votes, max_unsettled_share, increment: see plan_extensions
+    :param harvest_params: max_workers, max_per_second etc. passed to the harvesting functions and extend_hits
+    :return: hit_id: [boto assignment] dict of the harvested HITs, hit_id: assignments added dict
+    """
+    reviewable_hits = process_hits.get_completed_hits(mturk_connection, **harvest_params)
+    assignments_by_hit = process_hits.get_assignments(mturk_connection, reviewable_hits, **harvest_params)
+    extensions = plan_extensions(assignments_by_hit, max_assignments, min_agreement, min_votes, max_unsettled_share,
+                                 increment, consensus_method=consensus_method)
+    extend_params = {key: value for key, value in harvest_params.items()
+                     if key in ['max_workers', 'max_per_second', 'max_retries']}
+    return assignments_by_hit, extend_hits(mturk_connection, extensions, **extend_params)
+
+
+simulation_hit_params = {
+    'title': 'Label text boxes',
+    'description': 'Simulated HIT',
+    'keywords': 'simulation',
+    'amount': 0.10,
+    'frame_height': 800,
+    'duration': 3600,
+    'lifetime': 86400
+}
+
+
+def simulate_allocation(n_pages=200, initial_assignments=2, max_assignments=5, min_agreement=0.6, min_votes=2,
+                        max_unsettled_share=0.0, consensus_method='majority', no_consensus_flag='No Consensus',
+                        answers=None, seed=0, max_rounds=10):
+    """
+    Runs the adaptive policy end to end against a fake mturk connection whose synthetic workers answer every HIT
+    as soon as it's posted or extended.
+    Setting initial_assignments equal to max_assignments simulates the fixed allocation.
+    :param answers: fake_mturk.SyntheticAnswers, defaults to SyntheticAnswers(seed=seed)
+    :param max_rounds: most adaptive rounds to run. Rounds also stop once one extends no HIT successfully.
+    :return: dict with the assignments bought, rounds run, the share of boxes whose final consensus matches the
+    true label (accuracy) and the share left without consensus
+    """
+    answers = answers or fake_mturk.SyntheticAnswers(seed=seed)
+    fake_connection = fake_mturk.FakeMTurkConnection(answers=answers)
+    urls = [process_hits.form_hit_url('simulated_book.pdf', page_n) for page_n in range(n_pages)]
+    hit_params = dict(simulation_hit_params, max_assignments=initial_assignments)
+    process_hits.create_hits_from_pages(fake_connection, urls, hit_params)
+
+    n_rounds = 1
+    for _ in range(max_rounds):
+        _, extended = run_adaptive_round(fake_connection, max_assignments, min_agreement, min_votes,
+                                         max_unsettled_share, consensus_method=consensus_method)
+        if not any(not isinstance(result, Exception) for result in extended.values()):
+            break
+        n_rounds += 1
+
+    results_df = process_hits.make_results_df_from_assignments(fake_connection.assignments)
+    consensus_df = process_hits.make_consensus_df(results_df, no_consensus_flag, method=consensus_method)
+    true_labels_by_page = {page: answers.true_labels(page) for page in pd.unique(consensus_df['page'])}
+    true_categories = np.array([true_labels_by_page[page][box_id] for page, box_id in
+                                zip(consensus_df['page'], consensus_df['box_id'])], dtype=object)
+    consensus_categories = np.asarray(consensus_df['category'], dtype=object)
+    n_assignments = sum(len(hit_assignments) for hit_assignments in fake_connection.assignments.values())
+    return {
+        'n_pages': n_pages,
+        'assignments': n_assignments,
+        'assignments_per_page': n_assignments / float(n_pages),
+        'rounds': n_rounds,
+        'accuracy': (consensus_categories == true_categories).mean(),
+        'no_consensus_rate': (consensus_categories == no_consensus_flag).mean()
+    }
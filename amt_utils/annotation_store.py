@@ -0,0 +1,156 @@
+import json
+import os
+import sqlite3
+import threading
+
+"""
+A single-file store for page annotations, as an alternative to one json file per page. Pages are keyed by
+(book, page_n) and every box is indexed by book, box type (text, question, ...) and category, so corpus-wide
+queries don't need to open every page.
+"""
+
+
+def split_page_name(page_name):
+    """
+    Splits a page image or annotation file name into its book and page number.
+    :param page_name: e.g. 'Spectrum_Science_Grade_8_8.jpeg'
+    :return: ('Spectrum_Science_Grade_8', 8)
+    """
+    base_name = os.path.splitext(os.path.basename(page_name))[0].replace('\\', '')
+    book, page_n = base_name.rsplit('_', 1)
+    return book, int(page_n)
+
+
+class AnnotationStore(object):
+    """
+    SQLite-backed annotation store. Safe to share between threads.
+    """
+    def __init__(self, db_path):
+        """
+        :param db_path: sqlite database file, created if it doesn't exist
+        """
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (
+                book TEXT,
+                page_n INTEGER,
+                annotation TEXT,
+                PRIMARY KEY (book, page_n)
+            );
+            CREATE TABLE IF NOT EXISTS boxes (
+                book TEXT,
+                page_n INTEGER,
+                box_type TEXT,
+                box_id TEXT,
+                category TEXT
+            );
+            CREATE INDEX IF NOT EXISTS boxes_page ON boxes (book, page_n);
+            CREATE INDEX IF NOT EXISTS boxes_category ON boxes (category, box_type);
+            CREATE INDEX IF NOT EXISTS boxes_type ON boxes (box_type);
+        """)
+
+    def close(self):
+        self.connection.close()
+
+    def _put(self, book, page_n, annotation):
+        self.connection.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)',
+                                (book, page_n, json.dumps(annotation)))
+        self.connection.execute('DELETE FROM boxes WHERE book = ? AND page_n = ?', (book, page_n))
+        box_rows = [(book, page_n, box_type, box_id, box.get('category'))
+                    for box_type, type_boxes in annotation.items() if isinstance(type_boxes, dict)
+                    for box_id, box in type_boxes.items() if isinstance(box, dict)]
+        self.connection.executemany('INSERT INTO boxes VALUES (?, ?, ?, ?, ?)', box_rows)
+
+    def put(self, book, page_n, annotation):
+        """
+        Stores (or replaces) a page annotation.
+        """
+        with self.lock, self.connection:
+            self._put(book, page_n, annotation)
+
+    def put_many(self, pages):
+        """
+        Stores many page annotations in one transaction.
+        :param pages: iterable of (book, page_n, annotation)
+        """
+        with self.lock, self.connection:
+            for book, page_n, annotation in pages:
+                self._put(book, page_n, annotation)
+
+    def get(self, book, page_n):
+        """
+        :return: the page annotation, or None if the page isn't stored
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT annotation FROM pages WHERE book = ? AND page_n = ?',
+                                          (book, page_n)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_page(self, page_name):
+        """
+        :param page_name: page image or annotation file name, e.g. 'Spectrum_Science_Grade_8_8.jpeg'
+        :return: the page annotation, or None if the page isn't stored
+        """
+        return self.get(*split_page_name(page_name))
+
+    def put_page(self, page_name, annotation):
+        self.put(*(split_page_name(page_name) + (annotation,)))
+
+    def iter_pages(self, book=None):
+        """
+        :param book: only iterate pages of this book
+        :return: generator of (book, page_n, annotation), ordered by book and page
+        """
+        query = 'SELECT book, page_n, annotation FROM pages'
+        params = ()
+        if book is not None:
+            query += ' WHERE book = ?'
+            params = (book,)
+        with self.lock:
+            rows = self.connection.execute(query + ' ORDER BY book, page_n', params).fetchall()
+        for row_book, page_n, annotation in rows:
+            yield row_book, page_n, json.loads(annotation)
+
+    def find_boxes(self, book=None, category=None, box_type=None):
+        """
+        Finds boxes by book, category and/or box type through the box index, e.g. all question boxes in a book.
+        :return: list of (book, page_n, box_type, box_id, category)
+        """
+        filters = [(column, value) for column, value in [('book', book), ('category', category),
+                                                         ('box_type', box_type)] if value is not None]
+        query = 'SELECT book, page_n, box_type, box_id, category FROM boxes'
+        if filters:
+            query += ' WHERE ' + ' AND '.join(column + ' = ?' for column, _ in filters)
+        with self.lock:
+            return self.connection.execute(query + ' ORDER BY book, page_n, box_id',
+                                           [value for _, value in filters]).fetchall()
+
+    def import_json_dir(self, annotation_dir):
+        """
+        Loads every per-page annotation json file in a directory into the store.
+        :return: number of pages imported
+        """
+        def read_pages():
+            for file_name in sorted(os.listdir(annotation_dir)):
+                if file_name.endswith('.json'):
+                    with open(os.path.join(annotation_dir, file_name), 'r') as f:
+                        yield split_page_name(file_name) + (json.load(f),)
+        pages = list(read_pages())
+        self.put_many(pages)
+        return len(pages)
+
+    def export_json_dir(self, annotation_dir, book=None):
+        """
+        Writes stored pages back out in the per-page json layout (book_page_n.json).
+        :return: number of pages exported
+        """
+        if not os.path.isdir(annotation_dir):
+            os.makedirs(annotation_dir)
+        n_pages = 0
+        for page_book, page_n, annotation in self.iter_pages(book):
+            with open(os.path.join(annotation_dir, page_book + '_' + str(page_n) + '.json'), 'wb') as f:
+                json.dump(annotation, f)
+            n_pages += 1
+        return n_pages
@@ -0,0 +1,72 @@
+import json
+import os
+from multiprocessing import Pool
+
+import jsonschema
+
+from annotation_schema import page_schema
+
+"""
+Validation of page annotations against annotation_schema.page_schema. The schema is compiled into a validator
+once, at import, and annotations are validated as built in memory, with tuples accepted as json arrays.
+"""
+
+
+def build_page_validator(schema):
+    """
+    Compiles a Draft4 validator for schema that treats tuples as arrays, as json.dump does.
+    """
+    if hasattr(jsonschema.Draft4Validator, 'TYPE_CHECKER'):
+        type_checker = jsonschema.Draft4Validator.TYPE_CHECKER.redefine(
+            'array', lambda checker, instance: isinstance(instance, (list, tuple)))
+        validator_class = jsonschema.validators.extend(jsonschema.Draft4Validator, type_checker=type_checker)
+        return validator_class(schema)
+    return jsonschema.Draft4Validator(schema, types={'array': (list, tuple)})
+
+
+page_validator = build_page_validator(page_schema)
+
+
+def validate_page(annotation):
+    """
+    Validates a page annotation, raising jsonschema.ValidationError if it doesn't match the page schema.
+    :param annotation: page annotation dict
+    """
+    page_validator.validate(annotation)
+
+
+def count_annotation_file_errors(file_path):
+    """
+    :param file_path: annotation json file
+    :return: (file_path, number of schema errors), unreadable files count as one error
+    """
+    try:
+        with open(file_path, 'r') as f:
+            annotation = json.load(f)
+    except (IOError, ValueError):
+        return file_path, 1
+    return file_path, sum(1 for _ in page_validator.iter_errors(annotation))
+
+
+def validate_annotation_dir(annotation_dir, n_processes=None):
+    """
+    Validates every annotation json file in a directory across a pool of processes.
+    :param annotation_dir: directory of page annotation files
+    :param n_processes: worker processes, defaults to the number of cpus
+    :return: dict with the number of files checked, invalid files, total errors and errors per invalid file
+    """
+    file_paths = [os.path.join(annotation_dir, file_name) for file_name in sorted(os.listdir(annotation_dir))
+                  if file_name.endswith('.json')]
+    pool = Pool(n_processes)
+    try:
+        error_counts = pool.map(count_annotation_file_errors, file_paths, chunksize=64)
+    finally:
+        pool.close()
+        pool.join()
+    errors_by_file = {os.path.basename(file_path): n_errors for file_path, n_errors in error_counts if n_errors}
+    return {
+        'files': len(file_paths),
+        'invalid_files': len(errors_by_file),
+        'errors': sum(errors_by_file.values()),
+        'errors_by_file': errors_by_file
+    }
@@ -0,0 +1,401 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import timeit
+from copy import deepcopy
+import boto
+import boto.mturk.question as tq
+import pandas as pd
+
+import adaptive_allocation
+import fake_mturk
+import fake_mturk_server
+import instrumentation
+import ocr_pipeline
+import process_hits
+from stub_ocr_server import make_detections
+
+"""
+Offline benchmarks for the functions in process_hits and ocr_pipeline. Nothing here talks to mechanical turk;
+results are generated synthetically in the same shape the real pipeline produces.
+"""
+
+
+def make_synthetic_assignments(n_pages, assignments_per_hit=3, answers=None, seed=0, book='synthetic_book'):
+    """
+    Generates boto-like assignment objects (see fake_mturk.FakeAssignment), one HIT per page, answered by the
+    simulated workers of fake_mturk.SyntheticAnswers, each HIT by different workers.
+    :param n_pages: pages (and HITs) to generate
+    :param assignments_per_hit: assignments submitted for each HIT
+    :param answers: fake_mturk.SyntheticAnswers, defaults to SyntheticAnswers(seed=seed)
+    :param book: book name the page names are made from
+    :return: hit_id: [assignment] dict, page: {box_id: true category} dict
+    """
+    answers = answers or fake_mturk.SyntheticAnswers(seed=seed)
+    assignments_by_hit = {}
+    true_labels_by_page = {}
+    for page_n in range(n_pages):
+        hit_id = 'HIT' + str(page_n)
+        page = book + '_' + str(page_n) + '.jpeg'
+        true_labels_by_page[page] = answers.true_labels(page)
+        hit_assignments = []
+        done_by = set()
+        for assignment_n in range(assignments_per_hit):
+            worker_id = answers.pick_worker(done_by)
+            done_by.add(worker_id)
+            hit_assignments.append(fake_mturk.FakeAssignment(hit_id + '_A' + str(assignment_n), hit_id, worker_id,
+                                                             page, answers.label_page(worker_id, page)))
+        assignments_by_hit[hit_id] = hit_assignments
+    return assignments_by_hit, true_labels_by_page
+
+
+def make_synthetic_hit_results(n_boxes, assignments_per_hit=3, answers=None, seed=0):
+    """
+    Generates results shaped like the output of process_hits.process_raw_hits, see make_synthetic_assignments.
+    :param n_boxes: total number of labeled boxes (across all assignments) to generate
+    :return: hit_id: [{assignment_id: {page: [box, ...]}}] dict
+    """
+    answers = answers or fake_mturk.SyntheticAnswers(seed=seed)
+    n_hits = max(1, n_boxes // (len(answers.box_ids) * assignments_per_hit))
+    assignments_by_hit, _ = make_synthetic_assignments(n_hits, assignments_per_hit, answers)
+    return process_hits.process_raw_hits(assignments_by_hit)
+
+
+def time_call(func, *args, **kwargs):
+    """
+    Times a single call.
+    :return: function result, elapsed seconds
+    """
+    start = timeit.default_timer()
+    result = func(*args, **kwargs)
+    return result, timeit.default_timer() - start
+
+
+def benchmark_results_df(scales=(1000, 10000, 100000, 1000000), include_group_n=True):
+    """
+    Times building the results dataframe at several sizes. Time per box should stay flat as the size grows.
+    :param scales: numbers of labeled boxes to benchmark
+    :param include_group_n: benchmark the question results variant
+    :return: dataframe of timings, one row per scale
+    """
+    timings = []
+    for n_boxes in scales:
+        raw_hit_results = make_synthetic_hit_results(n_boxes)
+        results_df, seconds = time_call(process_hits.build_results_df, raw_hit_results, include_group_n)
+        timings.append({'n_boxes': len(results_df), 'seconds': seconds,
+                        'us_per_box': 1e6 * seconds / max(1, len(results_df))})
+    return pd.DataFrame(timings, columns=['n_boxes', 'seconds', 'us_per_box'])
+
+
+def benchmark_consensus_df(scales=(10000, 100000, 1000000, 3000000), no_consensus_flag='No Consensus'):
+    """
+    Times the consensus step on results dataframes of several sizes.
+    :param scales: numbers of votes (labeled boxes) to benchmark
+    :param no_consensus_flag: value filled in for tied boxes
+    :return: dataframe of timings, one row per scale
+    """
+    timings = []
+    for n_votes in scales:
+        results_df = process_hits.make_question_results_df(make_synthetic_hit_results(n_votes))
+        consensus_df, seconds = time_call(process_hits.make_consensus_df, results_df, no_consensus_flag)
+        timings.append({'n_votes': len(results_df), 'n_boxes': len(consensus_df), 'seconds': seconds,
+                        'us_per_vote': 1e6 * seconds / max(1, len(results_df))})
+    return pd.DataFrame(timings, columns=['n_votes', 'n_boxes', 'seconds', 'us_per_vote'])
+
+
+def legacy_make_consensus_df_w_worker_id(combined_results_df, combined_consensus_results_df):
+    """
+    The original per-group implementation of process_hits.make_consensus_df_w_worker_id, kept as a reference.
+    """
+    consensus_with_worker_id_df = pd.DataFrame(columns=list(combined_consensus_results_df.columns) + ['worker_id', 'consensus_category'])
+    for hitbox_id, rows in combined_results_df.groupby(['hit_id', 'box_id']):
+        this_consensus_row = combined_consensus_results_df[
+            (combined_consensus_results_df['hit_id'] == hitbox_id[0]) & (combined_consensus_results_df['box_id'] == hitbox_id[1])]
+        new_rows = rows.copy()
+        new_rows['consensus_category'] = this_consensus_row['category'].values[0]
+        consensus_with_worker_id_df = consensus_with_worker_id_df.append(new_rows)
+    return consensus_with_worker_id_df
+
+
+def benchmark_consensus_df_w_worker_id(scales=(1000, 5000, 20000, 1000000), max_legacy_votes=5000):
+    """
+    Times adding worker-level information to the consensus results, old vs. new.
+    :param scales: numbers of votes to benchmark
+    :param max_legacy_votes: largest scale the reference implementation is timed at
+    :return: dataframe of timings, one row per scale
+    """
+    timings = []
+    for n_votes in scales:
+        results_df = process_hits.make_question_results_df(make_synthetic_hit_results(n_votes))
+        consensus_df = process_hits.make_consensus_df(results_df, 'No Consensus')
+        _, seconds = time_call(process_hits.make_consensus_df_w_worker_id, results_df, consensus_df)
+        legacy_seconds = None
+        if n_votes <= max_legacy_votes:
+            _, legacy_seconds = time_call(legacy_make_consensus_df_w_worker_id, results_df, consensus_df)
+        timings.append({'n_votes': len(results_df), 'seconds': seconds, 'legacy_seconds': legacy_seconds})
+    return pd.DataFrame(timings, columns=['n_votes', 'seconds', 'legacy_seconds'])
+
+
+def legacy_build_hit_params(url, static_params):
+    """
+    The original deepcopy-per-HIT implementation of process_hits.build_hit_params, kept as a reference.
+    """
+    hit_params = deepcopy(static_params)
+    hit_params['qualifications'] = process_hits.build_qualifications()
+    hit_params['questionform'] = tq.ExternalQuestion(url, static_params['frame_height'])
+    hit_params['reward'] = boto.mturk.price.Price(hit_params['amount'])
+    return hit_params
+
+
+def benchmark_hit_params(n_urls=10000):
+    """
+    Times building HIT params for n_urls pages, deepcopy-per-HIT vs. a shared HITTemplate.
+    :param n_urls: number of page urls
+    :return: dataframe of timings
+    """
+    static_params = {
+        'title': "Annotate Science Questions",
+        'description': "Choose which category questions from a grade-school science book best belong to",
+        'keywords': ['image', 'science', 'text', 'labeling'],
+        'frame_height': 800,
+        'amount': 0.06,
+        'duration': 3600 * 12,
+        'lifetime': 3600 * 24 * 3,
+        'max_assignments': 3
+    }
+    urls = [process_hits.form_hit_url('synthetic_book.pdf', page_n) for page_n in range(n_urls)]
+
+    def build_with_template():
+        hit_template = process_hits.HITTemplate(static_params)
+        return [hit_template.hit_params(url) for url in urls]
+
+    _, legacy_seconds = time_call(lambda: [legacy_build_hit_params(url, static_params) for url in urls])
+    _, seconds = time_call(build_with_template)
+    return pd.DataFrame([{'n_urls': n_urls, 'seconds': seconds, 'legacy_seconds': legacy_seconds}],
+                        columns=['n_urls', 'seconds', 'legacy_seconds'])
+
+
+def benchmark_page_rendering(pdf_file, source_dir='pdfs/', last_page=None, scale_factor=0.66):
+    """
+    Times writing page images with and without pdfminer layout analysis, and checks the files written are identical.
+    :param pdf_file: pdf to render, ideally a few hundred pages
+    :param last_page: last page to render, None renders the whole book
+    :param scale_factor: passed to ocr_pipeline.render_pages
+    :return: dataframe of timings
+    """
+    laparams = ocr_pipeline.LAParams(0.5, 2.0, 0.5, 0.1, 0.5)
+    timings = []
+    written_files = {}
+    for analyze_layout in [True, False]:
+        images_folder = tempfile.mkdtemp()
+        try:
+            page_timings, seconds = time_call(ocr_pipeline.render_pages, pdf_file, 0, last_page, laparams,
+                                              source_dir, images_folder, scale_factor, analyze_layout)
+            written_files[analyze_layout] = {}
+            for file_name in os.listdir(images_folder):
+                with open(os.path.join(images_folder, file_name), 'rb') as f:
+                    written_files[analyze_layout][file_name] = f.read()
+        finally:
+            shutil.rmtree(images_folder)
+        timings.append({'analyze_layout': analyze_layout, 'n_pages': len(page_timings), 'seconds': seconds,
+                        'ms_per_page': 1e3 * seconds / max(1, len(page_timings))})
+    assert written_files[True] == written_files[False], 'page images differ between rendering paths'
+    return pd.DataFrame(timings, columns=['analyze_layout', 'n_pages', 'seconds', 'ms_per_page'])
+
+
+def benchmark_scale_image(image_dir, scale_factor=0.66, resample=None):
+    """
+    Times downscaling every image in a directory of sample page images, with JPEG draft decoding and with a full decode.
+    :param image_dir: directory of page images, e.g. unscaled output of ocr_pipeline.process_book
+    :param scale_factor: fraction of the original size to scale to
+    :param resample: PIL resampling filter, defaults to scale_image_data's
+    :return: dataframe of timings
+    """
+    image_data = []
+    for file_name in sorted(os.listdir(image_dir)):
+        with open(os.path.join(image_dir, file_name), 'rb') as f:
+            image_data.append(f.read())
+    scale_options = {'resample': resample} if resample is not None else {}
+
+    timings = []
+    for draft in [False, True]:
+        _, seconds = time_call(lambda: [ocr_pipeline.scale_image_data(data, scale_factor, draft=draft, **scale_options)
+                                        for data in image_data])
+        timings.append({'draft': draft, 'n_images': len(image_data), 'seconds': seconds,
+                        'ms_per_image': 1e3 * seconds / max(1, len(image_data))})
+    return pd.DataFrame(timings, columns=['draft', 'n_images', 'seconds', 'ms_per_image'])
+
+
+default_allocation_policies = [
+    {'initial_assignments': 3, 'max_assignments': 3},
+    {'initial_assignments': 2, 'max_assignments': 4, 'max_unsettled_share': 0.1},
+    {'initial_assignments': 2, 'max_assignments': 5},
+    {'initial_assignments': 2, 'max_assignments': 5, 'max_unsettled_share': 0.1, 'consensus_method': 'weighted'}
+]
+
+
+def benchmark_allocation_policies(policies=default_allocation_policies, n_pages=300, seed=0):
+    """
+    Compares the cost and accuracy of assignment allocation policies on the same simulated pages and workers.
+    :param policies: list of keyword argument dicts for adaptive_allocation.simulate_allocation
+    :return: dataframe with one row per policy
+    """
+    rows = []
+    for policy in policies:
+        outcome = adaptive_allocation.simulate_allocation(n_pages=n_pages, seed=seed, **policy)
+        outcome['policy'] = ', '.join('{}={}'.format(key, value) for key, value in sorted(policy.items()))
+        rows.append(outcome)
+    return pd.DataFrame(rows, columns=['policy', 'assignments_per_page', 'rounds', 'accuracy', 'no_consensus_rate'])
+
+
+def write_unannotated_pages(annotations_folder, n_pages, boxes_per_page=20, book='synthetic_book'):
+    """
+    Writes the ocr-only page annotations the labeled results are merged into, as ocr_pipeline would.
+    """
+    if not os.path.isdir(annotations_folder):
+        os.makedirs(annotations_folder)
+    ocr_results = {'detections': make_detections(boxes_per_page)}
+    for page_n in range(n_pages):
+        ocr_pipeline.write_annotation_file(ocr_results, page_n, book, annotations_folder)
+
+
+pipeline_stages = ['process_raw_hits', 'make_question_results_df', 'make_results_df_from_assignments',
+                   'make_consensus_df', 'make_consensus_df_w_worker_id', 'write_results_df']
+
+
+def benchmark_pipeline(scales=(100, 1000, 10000), assignments_per_hit=3, answers=None, no_consensus_flag='No Consensus',
+                       write_workers=8):
+    """
+    Times every stage from raw assignments to written annotation files, at several numbers of pages.
+    Annotation files are written to a temporary directory that is removed afterwards.
+    :param scales: numbers of pages to benchmark
+    :param answers: fake_mturk.SyntheticAnswers, defaults to SyntheticAnswers(seed=0) for every scale
+    :return: dataframe of timings, one row per scale and stage
+    """
+    timings = []
+    for n_pages in scales:
+        scale_answers = answers or fake_mturk.SyntheticAnswers(seed=0)
+        assignments_by_hit, _ = make_synthetic_assignments(n_pages, assignments_per_hit, scale_answers)
+        base_path = tempfile.mkdtemp() + '/'
+        try:
+            write_unannotated_pages(base_path + 'annotations/', n_pages, len(scale_answers.box_ids))
+            os.makedirs(base_path + 'labeled/')
+            recorder = instrumentation.enable()
+            try:
+                raw_hit_results = process_hits.process_raw_hits(assignments_by_hit)
+                process_hits.make_question_results_df(raw_hit_results)
+                results_df = process_hits.make_results_df_from_assignments(assignments_by_hit)
+                consensus_df = process_hits.make_consensus_df(results_df, no_consensus_flag)
+                process_hits.make_consensus_df_w_worker_id(results_df, consensus_df)
+                process_hits.write_results_df(consensus_df, 'annotations/', 'labeled/', base_path,
+                                              max_workers=write_workers)
+            finally:
+                instrumentation.disable()
+        finally:
+            shutil.rmtree(base_path)
+        stage_stats = recorder.summary()['stages']
+        for stage in pipeline_stages:
+            stats = stage_stats[stage]
+            timings.append({'n_pages': n_pages, 'stage': stage, 'seconds': stats['seconds'],
+                            'rows_in': stats['rows_in'], 'rows_out': stats['rows_out'],
+                            'us_per_row_in': 1e6 * stats['seconds'] / max(1, stats['rows_in'])})
+    return pd.DataFrame(timings, columns=['n_pages', 'stage', 'seconds', 'rows_in', 'rows_out', 'us_per_row_in'])
+
+
+def current_version():
+    """
+    :return: short git commit hash of the working tree, or 'unknown' outside a git checkout
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save_benchmark_results(timings, results_file='benchmark_results.csv', label=None):
+    """
+    Appends benchmark timings to a csv, tagged with a version label and time, so runs on different versions can
+    be compared.
+    :param timings: dataframe returned by one of the benchmark functions
+    :param label: defaults to the current git commit
+    :return: every saved result, including earlier runs
+    """
+    timings = timings.copy()
+    timings.insert(0, 'recorded_at', time.strftime('%Y-%m-%d %H:%M:%S'))
+    timings.insert(0, 'version', label or current_version())
+    if os.path.exists(results_file):
+        timings = pd.concat([pd.read_csv(results_file), timings], ignore_index=True)
+    timings.to_csv(results_file, index=False)
+    return timings
+
+
+def compare_benchmark_results(results_file='benchmark_results.csv', keys=('n_pages', 'stage')):
+    """
+    :return: seconds per benchmark case (rows) and version (columns), from the latest run of each version
+    """
+    saved = pd.read_csv(results_file)
+    latest = saved.drop_duplicates(['version'] + list(keys), keep='last')
+    return latest.pivot_table(index=list(keys), columns='version', values='seconds')
+
+
+lifecycle_hit_params = {
+    'title': 'Label text boxes',
+    'description': 'Load test HIT',
+    'keywords': 'load test',
+    'amount': 0.10,
+    'frame_height': 800,
+    'max_assignments': 3,
+    'duration': 3600,
+    'lifetime': 86400
+}
+
+
+def benchmark_mturk_lifecycle(n_hits=50000, worker_counts=(4, 16, 64), latency=0.01, throttle_probability=0.0,
+                              max_requests_per_second=None, max_per_second=None, over_http=False, seed=0):
+    """
+    Load tests posting, harvesting and approving HITs against the fake mturk connection, with synthetic workers
+    answering every HIT as soon as it's posted, to measure how much concurrency helps at a given request latency.
+    :param n_hits: HITs to post
+    :param worker_counts: max_workers values to compare
+    :param latency: seconds each fake request takes
+    :param throttle_probability: chance any single request is throttled
+    :param max_requests_per_second: the fake throttles requests above this rate
+    :param max_per_second: client-side rate limit passed to the process_hits functions
+    :param over_http: go through a real boto MTurkConnection and fake_mturk_server instead of calling the fake
+    :return: dataframe with one row per worker count and stage
+    """
+    urls = [process_hits.form_hit_url('load_test_book.pdf', page_n) for page_n in range(n_hits)]
+    timings = []
+    for max_workers in worker_counts:
+        fake_connection = fake_mturk.FakeMTurkConnection(latency, throttle_probability, max_requests_per_second,
+                                                         seed, answers=fake_mturk.SyntheticAnswers(seed=seed))
+        server = fake_mturk_server.FakeMTurkServer(fake_connection).start() if over_http else None
+        mturk_connection = server.connect() if server else fake_connection
+        request_params = {'max_workers': max_workers, 'max_per_second': max_per_second}
+        try:
+            stages = []
+            created, seconds = time_call(process_hits.create_hits_from_pages, mturk_connection, urls,
+                                         lifecycle_hit_params, **request_params)
+            stages.append(('create_hits_from_pages', seconds, len(created)))
+            hits, seconds = time_call(process_hits.get_completed_hits, mturk_connection, **request_params)
+            stages.append(('get_completed_hits', seconds, len(hits)))
+            assignments, seconds = time_call(process_hits.get_assignments, mturk_connection, hits,
+                                             **request_params)
+            stages.append(('get_assignments', seconds, sum(len(items) for items in assignments.values())))
+            summary, seconds = time_call(process_hits.accept_hits, mturk_connection, assignments, **request_params)
+            stages.append(('accept_hits', seconds, summary['succeeded']))
+        finally:
+            if server:
+                server.stop()
+        for stage, seconds, n_items in stages:
+            timings.append({'max_workers': max_workers, 'stage': stage, 'seconds': seconds, 'items': n_items,
+                            'items_per_second': n_items / seconds if seconds else 0.0})
+        timings.append({'max_workers': max_workers, 'stage': 'requests',
+                        'items': sum(fake_connection.request_counts.values()),
+                        'seconds': sum(seconds for _, seconds, _ in stages),
+                        'throttled': sum(fake_connection.throttled_counts.values())})
+    return pd.DataFrame(timings, columns=['max_workers', 'stage', 'seconds', 'items', 'items_per_second',
+                                          'throttled'])
@@ -0,0 +1,129 @@
+import hashlib
+import sqlite3
+import time
+import pandas as pd
+
+from process_hits import RESULT_COLUMNS, CATEGORICAL_RESULT_COLUMNS
+
+"""
+An on-disk record of harvested assignments, so repeated harvests of a live batch only parse what is new.
+"""
+
+
+def hash_answers(assignment):
+    """
+    Hashes the raw answer fields of a boto assignment object.
+    :param assignment: boto assignment object
+    :return: hex digest
+    """
+    answer_hash = hashlib.sha1()
+    for answers in assignment.answers:
+        for answer in answers:
+            for field in answer.fields:
+                answer_hash.update(field.encode('utf-8') if isinstance(field, unicode) else field)
+                answer_hash.update('\0')
+    return answer_hash.hexdigest()
+
+
+class CheckpointStore(object):
+    """
+    SQLite store of processed assignments (keyed by AssignmentId, with status and answer hash) and of the
+    text-box level results parsed from them.
+    """
+    def __init__(self, db_path):
+        """
+        :param db_path: sqlite database file, created if it doesn't exist
+        """
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS assignments (
+                assignment_id TEXT PRIMARY KEY,
+                hit_id TEXT,
+                worker_id TEXT,
+                status TEXT,
+                answer_hash TEXT,
+                processed_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                page TEXT,
+                category TEXT,
+                hit_id TEXT,
+                assignment_id TEXT,
+                box_id TEXT,
+                worker_id TEXT,
+                group_n TEXT
+            );
+            CREATE INDEX IF NOT EXISTS results_assignment_id ON results (assignment_id);
+        """)
+
+    def close(self):
+        self.connection.close()
+
+    def processed_assignments(self):
+        """
+        :return: assignment_id: (status, answer_hash) dict of everything processed so far
+        """
+        rows = self.connection.execute('SELECT assignment_id, status, answer_hash FROM assignments')
+        return {assignment_id: (status, answer_hash) for assignment_id, status, answer_hash in rows}
+
+    def new_or_changed(self, assignments_by_hit):
+        """
+        Filters harvested assignments down to those not yet processed, or whose status or answers changed.
+        :param assignments_by_hit: hit_id: [boto assignment] dict, as returned by process_hits.get_assignments
+        :return: hit_id: [boto assignment] dict
+        """
+        processed = self.processed_assignments()
+        changed = {}
+        for hit_id, hit_assignments in assignments_by_hit.items():
+            to_process = [assignment for assignment in hit_assignments
+                          if processed.get(assignment.AssignmentId) !=
+                          (assignment.AssignmentStatus, hash_answers(assignment))]
+            if to_process:
+                changed[hit_id] = to_process
+        return changed
+
+    def record_assignments(self, assignments_by_hit):
+        """
+        Marks assignments as processed.
+        :param assignments_by_hit: hit_id: [boto assignment] dict
+        """
+        processed_at = time.time()
+        rows = [(assignment.AssignmentId, hit_id, assignment.WorkerId, assignment.AssignmentStatus,
+                 hash_answers(assignment), processed_at)
+                for hit_id, hit_assignments in assignments_by_hit.items() for assignment in hit_assignments]
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO assignments VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def append_results(self, results_df, assignments_by_hit=None):
+        """
+        Adds results rows, replacing any rows stored earlier for the same assignments.
+        :param results_df: dataframe made by process_hits.make_results_df or make_question_results_df
+        :param assignments_by_hit: hit_id: [boto assignment] dict the rows were parsed from, see new_or_changed.
+        Every one of these assignments has its earlier rows replaced, including those that now have no boxes.
+        Defaults to the assignments found in results_df.
+        """
+        group_n = results_df['group_n'] if 'group_n' in results_df else [None] * len(results_df)
+        columns = [results_df[col].astype(object).values for col in RESULT_COLUMNS] + [group_n]
+        if assignments_by_hit is not None:
+            assignment_ids = [(assignment.AssignmentId,) for hit_assignments in assignments_by_hit.values()
+                              for assignment in hit_assignments]
+        else:
+            assignment_ids = [(assignment_id,) for assignment_id in pd.unique(results_df['assignment_id'])]
+        with self.connection:
+            self.connection.executemany('DELETE FROM results WHERE assignment_id = ?', assignment_ids)
+            self.connection.executemany('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?)', zip(*columns))
+
+    def load_results(self, include_group_n=True, categorical=True):
+        """
+        Loads every stored result.
+        :param include_group_n: include the group_n column
+        :param categorical: store page, category, hit_id and worker_id as pandas categoricals
+        :return: text-box level results in a pandas dataframe
+        """
+        col_names = RESULT_COLUMNS + ['group_n'] if include_group_n else RESULT_COLUMNS
+        results_df = pd.read_sql_query('SELECT {} FROM results'.format(', '.join(col_names)), self.connection)
+        if categorical:
+            for col in CATEGORICAL_RESULT_COLUMNS:
+                results_df[col] = pd.Categorical(results_df[col])
+        return results_df
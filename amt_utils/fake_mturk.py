@@ -0,0 +1,314 @@
+import itertools
+import json
+import random
+import threading
+import time
+import urlparse
+import zlib
+from collections import Counter, OrderedDict, defaultdict, deque
+
+from boto.mturk.connection import MTurkRequestError
+from boto.resultset import ResultSet
+
+"""
+An in-process stand-in for boto's MTurkConnection, for exercising the HIT lifecycle functions in process_hits
+without a mechanical turk account. It keeps HIT and assignment state, pages results like mturk does, simulates
+request latency and throttling, and can have synthetic workers answer HITs as soon as they're posted.
+See fake_mturk_server for serving it over HTTP to a real boto connection.
+"""
+
+default_categories = ['header/topic', 'definition', 'discussion', 'question', 'answer', 'figure_label', 'unlabeled']
+
+throttled_body = """<?xml version="1.0"?>
+<Response><Errors><Error><Code>AWS.ServiceUnavailable</Code>
+<Message>Rate exceeded, please slow down</Message></Error></Errors></Response>"""
+invalid_state_body = """<?xml version="1.0"?>
+<Response><Errors><Error><Code>AWS.MechanicalTurk.{}</Code>
+<Message>{}</Message></Error></Errors></Response>"""
+
+
+class FakeHIT(object):
+    """
+    Mimics the attributes of boto's HIT result objects that process_hits uses.
+    """
+    def __init__(self, hit_id, hit_params):
+        self.HITId = hit_id
+        self.HITTypeId = 'FAKE_HIT_TYPE'
+        self.HITStatus = 'Assignable'
+        self.params = hit_params
+        self.IsValid = 'True'
+
+
+class FakeAnswer(object):
+    """
+    Mimics boto's QuestionFormAnswer: a question identifier and its list of answer fields.
+    """
+    def __init__(self, qid, value):
+        self.qid = qid
+        self.fields = [value]
+
+
+class FakeAssignment(object):
+    """
+    Mimics the attributes of boto's Assignment objects that process_hits uses. The submitted form holds the page
+    name and the page's labeled boxes as a json string, the same as the annotation tool posts.
+    """
+    def __init__(self, assignment_id, hit_id, worker_id, page, boxes, status='Submitted'):
+        self.AssignmentId = assignment_id
+        self.HITId = hit_id
+        self.WorkerId = worker_id
+        self.AssignmentStatus = status
+        self.AcceptTime = '2016-01-01T00:00:00Z'
+        self.SubmitTime = '2016-01-01T00:01:00Z'
+        self.answers = [[FakeAnswer('page', page), FakeAnswer('results', json.dumps(boxes))]]
+
+
+def page_from_hit(hit):
+    """
+    :return: page image name from the url in a HIT's ExternalQuestion, see process_hits.form_hit_url
+    """
+    query = urlparse.parse_qs(urlparse.urlparse(hit.params['question'].external_url).query)
+    return query['url'][0]
+
+
+class SyntheticAnswers(object):
+    """
+    Answers HITs as a pool of simulated workers. Each page gets fixed true labels. Most workers give a box's true
+    label with good_accuracy; a share of careless workers only manage bad_accuracy. Wrong labels are picked
+    uniformly from the other categories.
+    """
+    def __init__(self, boxes_per_page=20, n_workers=50, good_accuracy=0.85, bad_accuracy=0.3, bad_worker_share=0.1,
+                 categories=default_categories, seed=None):
+        self.box_ids = ['T' + str(box_n) for box_n in range(1, boxes_per_page + 1)]
+        self.workers = ['W' + str(worker_n) for worker_n in range(n_workers)]
+        n_bad = int(round(n_workers * bad_worker_share))
+        self.accuracy = {worker_id: bad_accuracy if worker_n < n_bad else good_accuracy
+                         for worker_n, worker_id in enumerate(self.workers)}
+        self.categories = categories
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def true_labels(self, page):
+        """
+        :return: box_id: true category dict, the same every time for a page
+        """
+        page_rng = random.Random(zlib.crc32(page))
+        return {box_id: page_rng.choice(self.categories) for box_id in self.box_ids}
+
+    def label_page(self, worker_id, page):
+        """
+        :return: the worker's labeled boxes for a page
+        """
+        true_labels = self.true_labels(page)
+        accuracy = self.accuracy[worker_id]
+        boxes = []
+        with self.lock:
+            for box_id in self.box_ids:
+                category = true_labels[box_id]
+                if self.rng.random() >= accuracy:
+                    category = self.rng.choice([other for other in self.categories if other != category])
+                boxes.append({'id': box_id, 'category': category, 'group_n': 0})
+        return boxes
+
+    def pick_worker(self, done_by):
+        """
+        :param done_by: workers who already answered the HIT
+        :return: a worker who hasn't
+        """
+        with self.lock:
+            return self.rng.choice([worker for worker in self.workers if worker not in done_by])
+
+    def __call__(self, hit, done_by):
+        """
+        :param hit: HIT to answer
+        :param done_by: workers who already answered it
+        :return: worker_id, page, labeled boxes
+        """
+        page = page_from_hit(hit)
+        worker_id = self.pick_worker(done_by)
+        return worker_id, page, self.label_page(worker_id, page)
+
+
+def result_page(items, page_size, page_number):
+    """
+    Slices one page out of items as a boto ResultSet, with the paging attributes mturk sets (as strings).
+    """
+    start = (page_number - 1) * page_size
+    page = ResultSet()
+    page.extend(items[start:start + page_size])
+    page.NumResults = str(len(page))
+    page.PageNumber = str(page_number)
+    page.TotalNumResults = str(len(items))
+    return page
+
+
+class FakeMTurkConnection(object):
+    """
+    Keeps HITs in memory. Every request sleeps for the configured latency and may be throttled, either at random
+    or when requests arrive faster than max_requests_per_second.
+    """
+    def __init__(self, latency=0.0, throttle_probability=0.0, max_requests_per_second=None, seed=None,
+                 answers=None):
+        """
+        :param latency: seconds each request takes
+        :param throttle_probability: chance any single request is throttled
+        :param max_requests_per_second: requests above this rate (over a one second window) are throttled
+        :param seed: random seed for throttling
+        :param answers: optional SyntheticAnswers (or any function of (hit, workers done) returning
+        (worker_id, page, boxes)). When set, HITs are answered in full as soon as they're created or extended.
+        """
+        self.latency = latency
+        self.throttle_probability = throttle_probability
+        self.max_requests_per_second = max_requests_per_second
+        self.rng = random.Random(seed)
+        self.hits = OrderedDict()
+        self.request_counts = Counter()
+        self.throttled_counts = Counter()
+        self.recent_requests = deque()
+        self.assignments = defaultdict(list)
+        self.assignments_by_id = {}
+        self.blocked_workers = {}
+        self.hit_ids = itertools.count(1)
+        self.assignment_ids = itertools.count(1)
+        self.answers = answers
+        self.lock = threading.Lock()
+
+    def _throttle(self, operation):
+        now = time.time()
+        with self.lock:
+            self.request_counts[operation] += 1
+            while self.recent_requests and now - self.recent_requests[0] > 1.0:
+                self.recent_requests.popleft()
+            over_rate = self.max_requests_per_second and len(self.recent_requests) >= self.max_requests_per_second
+            throttled = over_rate or self.rng.random() < self.throttle_probability
+            if throttled:
+                self.throttled_counts[operation] += 1
+            else:
+                self.recent_requests.append(now)
+        if throttled:
+            raise MTurkRequestError(503, 'Service Unavailable', throttled_body)
+
+    def _request(self, operation):
+        self._throttle(operation)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def create_hit(self, **hit_params):
+        self._request('create_hit')
+        with self.lock:
+            hit_id = 'FAKEHIT' + str(next(self.hit_ids))
+            hit = FakeHIT(hit_id, hit_params)
+            self.hits[hit_id] = hit
+        if self.answers:
+            self.submit_open_assignments(hit_id)
+        return [hit]
+
+    def add_assignment(self, hit_id, worker_id, page, boxes, status='Submitted'):
+        """
+        Submits an assignment to a HIT as if a worker had completed it. Doesn't count as a request.
+        A HIT becomes reviewable once it has max_assignments assignments.
+        :param boxes: list of box dicts with at least id and category
+        :return: FakeAssignment
+        """
+        with self.lock:
+            assignment_id = 'FAKEASSIGNMENT' + str(next(self.assignment_ids))
+            assignment = FakeAssignment(assignment_id, hit_id, worker_id, page, boxes, status)
+            self.assignments[hit_id].append(assignment)
+            self.assignments_by_id[assignment_id] = assignment
+            hit = self.hits[hit_id]
+            if len(self.assignments[hit_id]) >= int(hit.params.get('max_assignments', 1)):
+                hit.HITStatus = 'Reviewable'
+        return assignment
+
+    def submit_open_assignments(self, hit_id):
+        """
+        Has the synthetic workers answer every open assignment of a HIT. Doesn't count as a request.
+        :return: the submitted assignments
+        """
+        submitted = []
+        with self.lock:
+            n_open = int(self.hits[hit_id].params.get('max_assignments', 1)) - len(self.assignments[hit_id])
+            done_by = set(assignment.WorkerId for assignment in self.assignments[hit_id])
+        for _ in range(n_open):
+            worker_id, page, boxes = self.answers(self.hits[hit_id], done_by)
+            done_by.add(worker_id)
+            submitted.append(self.add_assignment(hit_id, worker_id, page, boxes))
+        return submitted
+
+    def get_reviewable_hits(self, hit_type=None, status='Reviewable', sort_by='Expiration',
+                            sort_direction='Ascending', page_size=10, page_number=1):
+        self._request('get_reviewable_hits')
+        with self.lock:
+            reviewable = [hit for hit in self.hits.values() if hit.HITStatus == status]
+        return result_page(reviewable, page_size, page_number)
+
+    def get_assignments(self, hit_id, status=None, sort_by='SubmitTime', sort_direction='Ascending',
+                        page_size=10, page_number=1, response_groups=None):
+        self._request('get_assignments')
+        with self.lock:
+            hit_assignments = [assignment for assignment in self.assignments[hit_id]
+                               if status is None or assignment.AssignmentStatus == status]
+        return result_page(hit_assignments, page_size, page_number)
+
+    def search_hits(self, sort_by='CreationTime', sort_direction='Ascending', page_size=10, page_number=1,
+                    response_groups=None):
+        self._request('search_hits')
+        with self.lock:
+            hits = [hit for hit in self.hits.values() if hit.HITStatus != 'Disposed']
+        return result_page(hits, page_size, page_number)
+
+    def get_all_hits(self):
+        """
+        Pages through search_hits 100 HITs at a time, on demand, like boto does.
+        """
+        page_size = 100
+        total_records = int(self.search_hits(page_size=page_size).TotalNumResults)
+        n_pages = total_records // page_size + bool(total_records % page_size)
+        return itertools.chain.from_iterable(self.search_hits(page_size=page_size, page_number=page_n)
+                                             for page_n in range(1, n_pages + 1))
+
+    def _review_assignment(self, assignment_id, new_status):
+        with self.lock:
+            assignment = self.assignments_by_id.get(assignment_id)
+            if assignment is None:
+                error_code, message = 'AssignmentDoesNotExist', 'Assignment ' + assignment_id + ' does not exist'
+            elif assignment.AssignmentStatus != 'Submitted':
+                error_code, message = 'InvalidAssignmentState', 'Assignment ' + assignment_id + ' is ' + \
+                    assignment.AssignmentStatus
+            else:
+                assignment.AssignmentStatus = new_status
+                return
+        raise MTurkRequestError(200, 'OK', invalid_state_body.format(error_code, message))
+
+    def approve_assignment(self, assignment_id, feedback=None):
+        self._request('approve_assignment')
+        self._review_assignment(assignment_id, 'Approved')
+
+    def reject_assignment(self, assignment_id, feedback=None):
+        self._request('reject_assignment')
+        self._review_assignment(assignment_id, 'Rejected')
+
+    def block_worker(self, worker_id, reason):
+        self._request('block_worker')
+        with self.lock:
+            self.blocked_workers[worker_id] = reason
+
+    def disable_hit(self, hit_id, response_groups=None):
+        self._request('disable_hit')
+        with self.lock:
+            hit = self.hits.get(hit_id)
+            if hit is not None and hit.HITStatus != 'Disposed':
+                hit.HITStatus = 'Disposed'
+                return
+        raise MTurkRequestError(200, 'OK', invalid_state_body.format('InvalidHITState',
+                                                                     'HIT ' + hit_id + ' is already disposed'))
+
+    def extend_hit(self, hit_id, assignments_increment=None, expiration_increment=None):
+        self._request('extend_hit')
+        with self.lock:
+            hit = self.hits[hit_id]
+            if assignments_increment:
+                hit.params['max_assignments'] = int(hit.params.get('max_assignments', 1)) + assignments_increment
+                hit.HITStatus = 'Assignable'
+        if self.answers and assignments_increment:
+            self.submit_open_assignments(hit_id)
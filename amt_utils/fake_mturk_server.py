@@ -0,0 +1,157 @@
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+import boto.mturk.question as tq
+from boto.mturk.connection import MTurkConnection, MTurkRequestError
+
+"""
+Serves a fake_mturk.FakeMTurkConnection over HTTP, answering the mturk operations process_hits uses with the xml
+boto parses, so a real boto MTurkConnection (with its request signing, HTTP round trips and xml parsing) can be
+load tested locally.
+"""
+
+question_form_answers_ns = 'http://mechanicalturk.amazonaws.com/AWSMechanicalTurkDataSchemas/2005-10-01/' \
+                           'QuestionFormAnswers.xsd'
+
+
+def render_fields(element_name, fields):
+    return '<{0}>{1}</{0}>'.format(element_name, ''.join('<{0}>{1}</{0}>'.format(name, escape(str(value)))
+                                                         for name, value in fields))
+
+
+def render_hit(hit):
+    return render_fields('HIT', [('HITId', hit.HITId), ('HITTypeId', hit.HITTypeId), ('HITStatus', hit.HITStatus),
+                                 ('MaxAssignments', hit.params.get('max_assignments', 1))])
+
+
+def render_answers(assignment):
+    answers = ''.join('<Answer><QuestionIdentifier>{}</QuestionIdentifier><FreeText>{}</FreeText></Answer>'.format(
+        escape(answer.qid), escape(answer.fields[0])) for answers in assignment.answers for answer in answers)
+    return '<QuestionFormAnswers xmlns="{}">{}</QuestionFormAnswers>'.format(question_form_answers_ns, answers)
+
+
+def render_assignment(assignment):
+    return render_fields('Assignment', [('AssignmentId', assignment.AssignmentId), ('WorkerId', assignment.WorkerId),
+                                        ('HITId', assignment.HITId), ('AssignmentStatus', assignment.AssignmentStatus),
+                                        ('AcceptTime', assignment.AcceptTime), ('SubmitTime', assignment.SubmitTime),
+                                        ('Answer', render_answers(assignment))])
+
+
+def render_response(operation, result=''):
+    return ('<?xml version="1.0"?><{0}Response><OperationRequest><RequestId>fake</RequestId></OperationRequest>'
+            '{1}</{0}Response>').format(operation, result)
+
+
+def render_page(operation, page, render_item):
+    result = '<{0}Result><Request><IsValid>True</IsValid></Request><NumResults>{1}</NumResults>' \
+             '<TotalNumResults>{2}</TotalNumResults><PageNumber>{3}</PageNumber>{4}</{0}Result>'
+    return render_response(operation, result.format(operation, page.NumResults, page.TotalNumResults,
+                                                     page.PageNumber, ''.join(render_item(item) for item in page)))
+
+
+def parse_question(question_xml):
+    """
+    :return: the ExternalQuestion posted in a CreateHIT request
+    """
+    root = ElementTree.fromstring(question_xml)
+    fields = {element.tag.split('}')[-1]: element.text for element in root}
+    return tq.ExternalQuestion(fields['ExternalURL'], int(fields['FrameHeight']))
+
+
+def handle_operation(fake_connection, params):
+    """
+    Runs one mturk operation against the fake.
+    :param params: the request's form parameters
+    :return: xml response body
+    """
+    operation = params['Operation']
+    if operation == 'CreateHIT':
+        hit = fake_connection.create_hit(question=parse_question(params['Question']), title=params.get('Title'),
+                                         max_assignments=int(params.get('MaxAssignments', 1)))[0]
+        return render_response(operation, render_hit(hit))
+    if operation in ['GetReviewableHITs', 'SearchHITs']:
+        paging = {'page_size': int(params.get('PageSize', 10)), 'page_number': int(params.get('PageNumber', 1))}
+        if operation == 'GetReviewableHITs':
+            page = fake_connection.get_reviewable_hits(status=params.get('Status', 'Reviewable'), **paging)
+        else:
+            page = fake_connection.search_hits(**paging)
+        return render_page(operation, page, render_hit)
+    if operation == 'GetAssignmentsForHIT':
+        page = fake_connection.get_assignments(params['HITId'], status=params.get('AssignmentStatus'),
+                                               page_size=int(params.get('PageSize', 10)),
+                                               page_number=int(params.get('PageNumber', 1)))
+        return render_page(operation, page, render_assignment)
+    if operation == 'ApproveAssignment':
+        fake_connection.approve_assignment(params['AssignmentId'], params.get('RequesterFeedback'))
+    elif operation == 'RejectAssignment':
+        fake_connection.reject_assignment(params['AssignmentId'], params.get('RequesterFeedback'))
+    elif operation == 'BlockWorker':
+        fake_connection.block_worker(params['WorkerId'], params.get('Reason'))
+    elif operation == 'DisableHIT':
+        fake_connection.disable_hit(params['HITId'])
+    elif operation == 'ExtendHIT':
+        fake_connection.extend_hit(params['HITId'], int(params.get('MaxAssignmentsIncrement', 0)) or None)
+    else:
+        raise ValueError('unsupported operation: ' + operation)
+    return render_response(operation, '<{0}Result><Request><IsValid>True</IsValid></Request></{0}Result>'.format(
+        operation))
+
+
+class FakeMTurkServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fake_connection, port=0):
+        """
+        :param fake_connection: fake_mturk.FakeMTurkConnection holding the state, latency and throttling settings
+        :param port: port to listen on, 0 picks a free one
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeMTurkHandler)
+        self.fake_connection = fake_connection
+
+    def connect(self, num_retries=0):
+        """
+        :param num_retries: boto's own retries of 5xx responses; 0 leaves retrying to process_hits
+        :return: boto MTurkConnection talking to this server
+        """
+        connection = MTurkConnection(aws_access_key_id='FAKEKEY', aws_secret_access_key='FAKESECRET',
+                                     host='127.0.0.1', port=self.server_address[1], is_secure=False)
+        connection.num_retries = num_retries
+        return connection
+
+    def start(self):
+        """
+        Serves requests from a daemon thread.
+        :return: the server, for chaining
+        """
+        server_thread = threading.Thread(target=self.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeMTurkHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        params = {name: values[0] for name, values in urlparse.parse_qs(body, keep_blank_values=True).items()}
+        try:
+            status, reason = 200, 'OK'
+            response = handle_operation(self.server.fake_connection, params)
+        except MTurkRequestError as e:
+            status, reason, response = e.status, e.reason, e.body
+        self.send_response(status, reason)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,289 @@
+import bisect
+import cProfile
+import functools
+import inspect
+import json
+import pstats
+import threading
+import time
+from collections import OrderedDict
+from StringIO import StringIO
+
+"""
+Optional per-stage instrumentation for the annotation pipeline: wall time, call counts, rows in and out, and
+request latency histograms, with an optional cProfile per stage.
+Nothing is recorded until enable() is called; while disabled, instrumented functions only check a global.
+"""
+
+latency_buckets_ms = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+_recorder = None
+
+
+def count_rows(value):
+    """
+    Counts the rows in a stage's input or output: the length of a dataframe or list, the number of assignments
+    in a hit_id: [assignment] dict, or an int as is.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, (int, long)):
+        return value
+    if isinstance(value, dict):
+        return sum(len(item) if isinstance(item, list) else 1 for item in value.values())
+    try:
+        return len(value)
+    except TypeError:
+        return 0
+
+
+class StageStats(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows_in = 0
+        self.rows_out = 0
+
+    def as_dict(self):
+        return OrderedDict([
+            ('calls', self.calls),
+            ('errors', self.errors),
+            ('seconds', self.seconds),
+            ('mean_seconds', self.seconds / self.calls if self.calls else 0.0),
+            ('max_seconds', self.max_seconds),
+            ('rows_in', self.rows_in),
+            ('rows_out', self.rows_out),
+            ('rows_out_per_second', self.rows_out / self.seconds if self.seconds else 0.0)
+        ])
+
+
+class LatencyHistogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(latency_buckets_ms) + 1)
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+
+    def add(self, seconds, failed):
+        self.counts[bisect.bisect_left(latency_buckets_ms, seconds * 1e3)] += 1
+        self.calls += 1
+        self.errors += failed
+        self.seconds += seconds
+
+    def as_dict(self):
+        labels = ['<=' + str(bound) + 'ms' for bound in latency_buckets_ms] + ['>' + str(latency_buckets_ms[-1]) + 'ms']
+        return OrderedDict([
+            ('calls', self.calls),
+            ('errors', self.errors),
+            ('mean_ms', 1e3 * self.seconds / self.calls if self.calls else 0.0),
+            ('histogram', OrderedDict(zip(labels, self.counts)))
+        ])
+
+
+class Recorder(object):
+    """
+    Collects stage and request statistics. Safe to share between threads.
+    """
+    def __init__(self, profile=False):
+        """
+        :param profile: run each outermost instrumented stage under cProfile
+        """
+        self.profile = profile
+        self.stages = OrderedDict()
+        self.requests = OrderedDict()
+        self.profiles = {}
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def record_stage(self, stage, seconds, rows_in=0, rows_out=0, failed=False):
+        with self.lock:
+            stats = self.stages.setdefault(stage, StageStats())
+            stats.calls += 1
+            stats.errors += failed
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.rows_in += rows_in
+            stats.rows_out += rows_out
+
+    def record_request(self, operation, seconds, failed=False):
+        with self.lock:
+            self.requests.setdefault(operation, LatencyHistogram()).add(seconds, failed)
+
+    def start_profile(self):
+        """
+        :return: a running profiler, or None if profiling is off or a stage on this thread is already profiled
+        """
+        if not self.profile or getattr(self.local, 'profiling', False):
+            return None
+        self.local.profiling = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def stop_profile(self, stage, profiler):
+        profiler.disable()
+        self.local.profiling = False
+        with self.lock:
+            if stage in self.profiles:
+                self.profiles[stage].add(profiler)
+            else:
+                self.profiles[stage] = pstats.Stats(profiler)
+
+    def summary(self):
+        """
+        :return: dict of stage and request statistics
+        """
+        with self.lock:
+            return OrderedDict([
+                ('elapsed_seconds', time.time() - self.start_time),
+                ('stages', OrderedDict((stage, stats.as_dict()) for stage, stats in self.stages.items())),
+                ('requests', OrderedDict((operation, histogram.as_dict())
+                                         for operation, histogram in self.requests.items()))
+            ])
+
+    def profile_report(self, stage, sort_by='cumulative', limit=20):
+        """
+        :return: pstats text of a stage's profile, or None if it wasn't profiled
+        """
+        with self.lock:
+            stats = self.profiles.get(stage)
+            if stats is None:
+                return None
+            stream = StringIO()
+            stats.stream = stream
+            stats.sort_stats(sort_by).print_stats(limit)
+        return stream.getvalue()
+
+    def text_report(self, profile_limit=0):
+        """
+        :param profile_limit: functions listed per profiled stage, 0 leaves the profiles out
+        :return: the summary formatted as text tables
+        """
+        summary = self.summary()
+        lines = ['{:<32}{:>8}{:>8}{:>12}{:>12}{:>12}{:>12}'.format('stage', 'calls', 'errors', 'seconds',
+                                                                   'rows in', 'rows out', 'rows/s')]
+        for stage, stats in summary['stages'].items():
+            lines.append('{:<32}{:>8}{:>8}{:>12.3f}{:>12}{:>12}{:>12.1f}'.format(
+                stage, stats['calls'], stats['errors'], stats['seconds'], stats['rows_in'], stats['rows_out'],
+                stats['rows_out_per_second']))
+        if summary['requests']:
+            lines += ['', '{:<32}{:>8}{:>8}{:>12}  {}'.format('request', 'calls', 'errors', 'mean ms', 'latency')]
+            for operation, histogram in summary['requests'].items():
+                buckets = ' '.join('{}:{}'.format(label, count)
+                                   for label, count in histogram['histogram'].items() if count)
+                lines.append('{:<32}{:>8}{:>8}{:>12.1f}  {}'.format(operation, histogram['calls'],
+                                                                     histogram['errors'], histogram['mean_ms'],
+                                                                     buckets))
+        lines.append('')
+        lines.append('elapsed: {:.3f}s'.format(summary['elapsed_seconds']))
+        if profile_limit:
+            for stage in summary['stages']:
+                stage_profile = self.profile_report(stage, limit=profile_limit)
+                if stage_profile:
+                    lines += ['', 'profile: ' + stage, stage_profile]
+        return '\n'.join(lines)
+
+    def write_json(self, file_path):
+        with open(file_path, 'wb') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def enable(profile=False):
+    """
+    Starts recording. Replaces any recorder that was already active.
+    :param profile: also run each outermost instrumented stage under cProfile (threads in a pool aren't profiled)
+    :return: the active Recorder
+    """
+    global _recorder
+    _recorder = Recorder(profile)
+    return _recorder
+
+
+def disable():
+    """
+    Stops recording.
+    :return: the Recorder that was active, or None
+    """
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+
+def active_recorder():
+    return _recorder
+
+
+def record_request(operation, seconds, failed=False):
+    """
+    Records one request's latency when instrumentation is enabled.
+    """
+    recorder = _recorder
+    if recorder is not None:
+        recorder.record_request(operation, seconds, failed)
+
+
+class stage(object):
+    """
+    Context manager timing a block as a stage, e.g.
+    with instrumentation.stage('review') as block:
+        ...
+        block.rows_out = n_reviewed
+    """
+    def __init__(self, name, rows_in=0):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = 0
+
+    def __enter__(self):
+        self.recorder = _recorder
+        if self.recorder is not None:
+            self.profiler = self.recorder.start_profile()
+            self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.recorder is not None:
+            seconds = time.time() - self.start
+            if self.profiler:
+                self.recorder.stop_profile(self.name, self.profiler)
+            self.recorder.record_stage(self.name, seconds, self.rows_in, self.rows_out, exc_type is not None)
+        return False
+
+
+def instrumented(stage_name=None, rows_in=None, rows_out=True):
+    """
+    Decorator recording a function as a pipeline stage.
+    :param stage_name: defaults to the function's name
+    :param rows_in: name of the argument whose rows are counted as the stage's input, see count_rows
+    :param rows_out: count the rows of the return value as the stage's output
+    """
+    def decorator(func):
+        name = stage_name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            recorder = _recorder
+            if recorder is None:
+                return func(*args, **kwargs)
+            n_in = count_rows(inspect.getcallargs(func, *args, **kwargs)[rows_in]) if rows_in else 0
+            profiler = recorder.start_profile()
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                if profiler:
+                    recorder.stop_profile(name, profiler)
+                recorder.record_stage(name, time.time() - start, n_in, 0, failed=True)
+                raise
+            seconds = time.time() - start
+            if profiler:
+                recorder.stop_profile(name, profiler)
+            recorder.record_stage(name, seconds, n_in, count_rows(result) if rows_out else 0)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+"""
+A persistent cache of OCR service responses, keyed by the page image's content hash and the request parameters,
+so unchanged pages are never sent to the service twice. Least recently used responses are evicted once the cache
+grows past its size limit.
+"""
+
+
+def hash_file(file_path, chunk_size=1 << 20):
+    """
+    :return: sha1 hex digest of a file's contents
+    """
+    file_hash = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def request_key(content_id, request_params):
+    """
+    :param content_id: identifies the image, e.g. 'sha1:' + its content hash
+    :param request_params: OCR request options that change the response, e.g. mergeBoxes
+    :return: cache key
+    """
+    return hashlib.sha1(content_id + '\0' + json.dumps(request_params, sort_keys=True)).hexdigest()
+
+
+class OCRCache(object):
+    """
+    SQLite-backed LRU cache of OCR responses. Safe to share between threads.
+    """
+    def __init__(self, db_path, max_bytes=1 << 30):
+        """
+        :param db_path: sqlite database file, created if it doesn't exist
+        :param max_bytes: total size of stored responses to keep, least recently used are evicted beyond it
+        """
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT,
+                size INTEGER,
+                last_used REAL
+            );
+            CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+        """)
+        self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, key):
+        """
+        :return: the cached response, or None
+        """
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute('UPDATE responses SET last_used = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, response):
+        """
+        Stores a response, then evicts least recently used responses while the cache is over max_bytes.
+        """
+        response_json = json.dumps(response)
+        with self.lock, self.connection:
+            old_size = self.connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                                    (key, response_json, len(response_json), time.time()))
+            self.total_bytes += len(response_json) - (old_size[0] if old_size else 0)
+            self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            oldest = self.connection.execute('SELECT key, size FROM responses ORDER BY last_used LIMIT 100').fetchall()
+            if not oldest:
+                break
+            evicted = []
+            for key, size in oldest:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                evicted.append((key,))
+                self.total_bytes -= size
+            self.connection.executemany('DELETE FROM responses WHERE key = ?', evicted)
+            self.evictions += len(evicted)
+
+    def stats(self):
+        """
+        :return: dict of hits, misses and evictions since opening, and the stored entries and bytes
+        """
+        with self.lock:
+            n_entries = self.connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': n_entries,
+                    'bytes': self.total_bytes}
@@ -1,10 +1,14 @@
+import errno
 import requests
 import json
-import jsonschema
 import os
-from binascii import b2a_hex
 import PIL.Image as Image
 import io
+import threading
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
 
 from collections import OrderedDict
 from collections import defaultdict
@@ -14,84 +18,165 @@ from pdfminer.pdfdocument import PDFDocument
 from pdfminer.pdfpage import PDFPage
 from pdfminer.pdfinterp import PDFResourceManager
 from pdfminer.pdfinterp import PDFPageInterpreter
-from pdfminer.layout import LAParams
+from pdfminer.layout import LAParams, LTImage
+from pdfminer.pdfdevice import PDFDevice
 from pdfminer.converter import PDFPageAggregator
 
-from annotation_schema import page_schema
+from annotation_validation import validate_page
+from ocr_cache import hash_file, request_key
+from throttling import call_with_retry
+
+
+ocr_api_entry_point = 'http://vision-ocr.dev.allenai.org/v1/ocr'
+default_jpeg_quality = 75
+page_image_base_url = 'https://s3-us-west-2.amazonaws.com/ai2-vision-turk-data/textbook-annotation-test/smaller-page-images/'
+
+
+image_signatures = [
+    ('\xff\xd8', '.jpeg'),
+    ('\x89PNG', '.png'),
+    ('GIF8', '.gif'),
+    ('BM', '.bmp')
+]
 
 
 def determine_image_type (stream_first_4_bytes):
-    file_type = None
-    bytes_as_hex = b2a_hex(stream_first_4_bytes)
-    if bytes_as_hex.startswith('ffd8'):
-        file_type = '.jpeg'
-    elif bytes_as_hex == '89504e47':
-        file_type = '.png'
-    elif bytes_as_hex == '47494638':
-        file_type = '.gif'
-    elif bytes_as_hex.startswith('424d'):
-        file_type = '.bmp'
-    return file_type
-
-
-def save_image(lt_image, page_n, book, images_folder):
-    result = None
-    if lt_image.stream:
-        file_stream = lt_image.stream.get_rawdata()
-        if file_stream:
-            file_ext = determine_image_type(file_stream[0:4])
-            if file_ext:
-                file_name = book + '_' + str(page_n) + file_ext
-                if write_file(images_folder, file_name, file_stream, flags='wb'):
-                    result = file_name
-    return result
+    header = memoryview(stream_first_4_bytes)
+    for signature, file_type in image_signatures:
+        if header[:len(signature)] == signature:
+            return file_type
+    return None
 
 
-def scale_and_save_image(pdf_page_image, page_n, book, images_folder, scale_factor):
+def scale_and_save_image(pdf_page_image, page_n, book, images_folder, scale_factor, resample=Image.ANTIALIAS,
+                         quality=default_jpeg_quality, draft=True):
     result = None
     file_ext = '.jpeg'
     file_name = book + '_' + str(page_n) + file_ext
-    file_stream = scale_image(pdf_page_image, scale_factor)
+    file_stream = scale_image(pdf_page_image, scale_factor, resample, draft)
     if file_stream.size:
-        file_stream.save(images_folder + '/' + file_name, format="JPEG")
+        file_stream.save(images_folder + '/' + file_name, format="JPEG", quality=quality)
+        result = file_name
 
     return result
 
 
-def write_file(folder, filename, filedata, flags='w'):
-    result = False
-    if os.path.isdir(folder):
-        file_obj = open(os.path.join(folder, filename), flags)
-        file_obj.write(filedata)
-        file_obj.close()
-        result = True
-    return result
-
-
-def scale_image(pdf_page_image, scale_factor):
-    page_image = Image.open(io.BytesIO(pdf_page_image.stream.get_rawdata()))
+def scale_image(pdf_page_image, scale_factor, resample=Image.ANTIALIAS, draft=True):
+    return scale_image_data(pdf_page_image.stream.get_rawdata(), scale_factor, resample, draft)
+
+
+def scale_image_data(image_data, scale_factor, resample=Image.ANTIALIAS, draft=True):
+    """
+    Decodes, downscales and grayscales an encoded page image.
+    With draft, JPEG sources are decoded straight to grayscale and at the smallest DCT scale (1/2, 1/4 or 1/8)
+    that is still at least the target size. Without it the image is fully decoded before resizing, which is the
+    baseline benchmarks.benchmark_scale_image compares against; PIL's thumbnail would otherwise draft a JPEG
+    itself. Other formats are fully decoded either way.
+    :param image_data: encoded image bytes
+    :param scale_factor: fraction of the original size to scale to
+    :param resample: PIL resampling filter used to reach the final size
+    :param draft: use JPEG draft mode decoding
+    :return: grayscale PIL image
+    """
+    page_image = Image.open(io.BytesIO(image_data))
     img_dim = tuple([int(dim*scale_factor) for dim in page_image.size])
-    page_image.thumbnail(img_dim, Image.ANTIALIAS)
+    if draft and page_image.format == 'JPEG' and all(img_dim):
+        page_image.draft('L', img_dim)
+    else:
+        page_image.load()
+    page_image.thumbnail(img_dim, resample)
     return page_image.convert('L')
 
 
+def make_dirs(folder):
+    """
+    Creates folder if it is missing. Safe to call from concurrent workers: one that loses the race to create it
+    doesn't fail.
+    """
+    try:
+        os.makedirs(folder)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(folder):
+            raise
+
+
 def record_image_size(pdf_page_image):
     page_image = Image.open(io.BytesIO(pdf_page_image))
     img_dim = page_image.size
     return img_dim
 
 
-def write_image_file(layout, page_n, book, dir_name, scale_factor=0):
+class PageImageWriter(object):
+    """
+    Writes the page images of one book. The output folder is created when the writer is, rather than checked for
+    every page, and unscaled images are written straight from the pdf stream's raw bytes without being decoded or
+    copied. Reuse one writer for all the pages of a book.
+    """
+    def __init__(self, images_folder, scale_factor=0, **scale_options):
+        """
+        :param images_folder: output folder, created if missing
+        :param scale_factor: fraction of the original size to scale to, 0 writes the embedded image as-is
+        :param scale_options: resample, quality and draft options passed to scale_and_save_image
+        """
+        make_dirs(images_folder)
+        self.images_folder = images_folder
+        self.scale_factor = scale_factor
+        self.scale_options = scale_options
+
+    def write(self, page_image, page_n, book):
+        """
+        :param page_image: pdfminer LTImage
+        :return: file name written, or None if nothing was written
+        """
+        if not page_image.stream:
+            return None
+        if self.scale_factor:
+            return scale_and_save_image(page_image, page_n, book, self.images_folder, self.scale_factor,
+                                        **self.scale_options)
+        file_stream = page_image.stream.get_rawdata()
+        file_ext = determine_image_type(file_stream) if file_stream else None
+        if not file_ext:
+            return None
+        file_name = book + '_' + str(page_n) + file_ext
+        with open(os.path.join(self.images_folder, file_name), 'wb') as f:
+            f.write(memoryview(file_stream))
+        return file_name
+
+
+class PageImageDevice(PDFDevice):
+    """
+    A pdfminer device that skips text and layout analysis entirely and only keeps the images drawn on a page,
+    in drawing order.
+    """
+    def __init__(self, rsrcmgr):
+        PDFDevice.__init__(self, rsrcmgr)
+        self.page_images = []
+
+    def begin_page(self, page, ctm):
+        self.page_images = []
+
+    def render_image(self, name, stream):
+        self.page_images.append(LTImage(name, stream, (0, 0, 1, 1)))
+
+
+def first_figure_image(layout):
     figure_detections = [detection for detection in layout._objs if type(detection) == pdfminer.layout.LTFigure][0]
-    page_image = figure_detections._objs[0]
-    if not scale_factor:
-        save_image(page_image, page_n, book, dir_name)
-    else:
-        scale_and_save_image(page_image, page_n, book, dir_name, scale_factor)
-    return
+    return figure_detections._objs[0]
 
 
-def write_annotation_file(ocr_results, page_n, book, annotations_folder):
+def write_image_file(layout, page_n, book, dir_name, scale_factor=0, image_writer=None, **scale_options):
+    """
+    Writes the first figure image of an analyzed page layout, see PageImageWriter.
+    :param image_writer: optional PageImageWriter to reuse across the pages of a book, dir_name, scale_factor and
+    scale_options are ignored when it is given
+    :return: file name written, or None if nothing was written
+    """
+    if image_writer is None:
+        image_writer = PageImageWriter(dir_name, scale_factor, **scale_options)
+    return image_writer.write(first_figure_image(layout), page_n, book)
+
+
+def write_annotation_file(ocr_results, page_n, book, annotations_folder, store=None):
 
     def point_to_tuple(box):
         return tuple(OrderedDict(sorted(box.items())).values())
@@ -128,9 +213,11 @@ def write_annotation_file(ocr_results, page_n, book, annotations_folder):
     annotation['figure'] = {}
     annotation['relationship'] = {}
 
-    validator = jsonschema.Draft4Validator(page_schema)
-    validator.validate(json.loads(json.dumps(annotation)))
+    validate_page(annotation)
 
+    if store is not None:
+        store.put(book, page_n, annotation)
+        return
     file_ext = ".json"
     file_path = annotations_folder + '/' + book + '_' + str(page_n) + file_ext
     with open(file_path, 'wb') as f:
@@ -138,12 +225,13 @@ def write_annotation_file(ocr_results, page_n, book, annotations_folder):
     return
 
 
-def query_vision_ocr(image_url, merge_boxes=False, include_merged_components=False, as_json=True):
-    print image_url
-    req = requests.get(image_url)
-    tpi = Image.open(io.BytesIO(req.content))
-    print(tpi.info, tpi.size, tpi.size[0]*tpi.size[1])
-    api_entry_point = 'http://vision-ocr.dev.allenai.org/v1/ocr'
+def query_vision_ocr(image_url, merge_boxes=False, include_merged_components=False, as_json=True, debug=True,
+                     session=None, api_entry_point=ocr_api_entry_point):
+    if debug:
+        print image_url
+        req = requests.get(image_url)
+        tpi = Image.open(io.BytesIO(req.content))
+        print(tpi.info, tpi.size, tpi.size[0]*tpi.size[1])
     header = {'Content-Type': 'application/json'}
     request_data = {
         'url': image_url,
@@ -153,12 +241,103 @@ def query_vision_ocr(image_url, merge_boxes=False, include_merged_components=Fal
     }
 
     json_data = json.dumps(request_data)
-    response = requests.post(api_entry_point, data=json_data, headers=header)
-    print(response.reason)
-    json_response = json.loads(response.content.decode())
-    if as_json:
-        response = json_response
-    return response
+    response = (session or requests).post(api_entry_point, data=json_data, headers=header)
+    if debug:
+        print(response.reason)
+    if not as_json:
+        return response
+    response.raise_for_status()
+    return json.loads(response.content.decode())
+
+
+def page_image_path(images_folder, book_name, page_n):
+    """
+    :return: path of the local page image written by PageImageWriter, or None if there isn't one
+    """
+    for _, file_ext in image_signatures:
+        file_path = os.path.join(images_folder, book_name + '_' + str(page_n) + file_ext)
+        if os.path.isfile(file_path):
+            return file_path
+    return None
+
+
+def ocr_cache_key(image_url, image_path=None, merge_boxes=False, include_merged_components=False):
+    """
+    Keys OCR responses by the page image's content hash when its local copy is given, by its url otherwise,
+    and by the request options that change the response.
+    """
+    content_id = 'sha1:' + hash_file(image_path) if image_path else 'url:' + image_url
+    return request_key(content_id, {'mergeBoxes': merge_boxes, 'includeMergedComponents': include_merged_components})
+
+
+def query_vision_ocr_cached(image_url, cache, image_path=None, merge_boxes=False, include_merged_components=False,
+                            **query_params):
+    """
+    query_vision_ocr through an ocr_cache.OCRCache: the service is only called for responses not cached yet.
+    :param cache: ocr_cache.OCRCache
+    :param image_path: local copy of the page image, see ocr_cache_key
+    :param query_params: passed to query_vision_ocr (debug, session, api_entry_point)
+    :return: OCR response json
+    """
+    key = ocr_cache_key(image_url, image_path, merge_boxes, include_merged_components)
+    ocr_response = cache.get(key)
+    if ocr_response is None:
+        ocr_response = query_vision_ocr(image_url, merge_boxes, include_merged_components, **query_params)
+        cache.put(key, ocr_response)
+    return ocr_response
+
+
+def render_pages(pdf_file, first_page, last_page, laparams, source_dir='pdfs/',
+                 images_folder='smaller_page_images', scale_factor=0.66, analyze_layout=False, scale_options=None):
+    """
+    Writes the page image of a range of pages from one pdf.
+    By default the pages are interpreted with a PageImageDevice, which only collects images. With analyze_layout
+    the full pdfminer layout analysis runs first, as it used to; the first image written is the same either way.
+    :param pdf_file: pdf file name
+    :param first_page: first page number to render
+    :param last_page: last page number to render (inclusive), None renders to the end of the book
+    :param laparams: pdfminer LAParams, only used with analyze_layout
+    :param analyze_layout: locate the image through pdfminer's layout analysis
+    :param scale_options: resample, quality and draft options passed to scale_and_save_image
+    :return: list of (page_n, seconds spent on the page)
+    """
+    return [(page_n, seconds) for page_n, _, seconds in
+            iter_rendered_pages(pdf_file, first_page, last_page, laparams, source_dir, images_folder, scale_factor,
+                                analyze_layout, scale_options)]
+
+
+def iter_rendered_pages(pdf_file, first_page, last_page, laparams, source_dir='pdfs/',
+                        images_folder='smaller_page_images', scale_factor=0.66, analyze_layout=False,
+                        scale_options=None, skip_page=None):
+    """
+    Renders pages one at a time, see render_pages.
+    :param skip_page: optional function of page_n, pages it returns True for aren't interpreted or written
+    :return: generator of (page_n, image file name, seconds spent on the page)
+    """
+    book_name = pdf_file.replace('.pdf', '')
+    image_writer = PageImageWriter(images_folder, scale_factor, **(scale_options or {}))
+    with open(source_dir + pdf_file, 'rb') as fp:
+        parser = PDFParser(fp)
+        document = PDFDocument(parser)
+        rsrcmgr = PDFResourceManager()
+        if analyze_layout:
+            device = PDFPageAggregator(rsrcmgr, laparams=laparams)
+        else:
+            device = PageImageDevice(rsrcmgr)
+        interpreter = PDFPageInterpreter(rsrcmgr, device)
+
+        for page_n, page in enumerate(PDFPage.create_pages(document)):
+            if last_page is not None and page_n > last_page:
+                break
+            if page_n >= first_page and not (skip_page and skip_page(page_n)):
+                start_time = time.time()
+                interpreter.process_page(page)
+                if analyze_layout:
+                    page_image = first_figure_image(device.get_result())
+                else:
+                    page_image = device.page_images[0]
+                file_name = image_writer.write(page_image, page_n, book_name)
+                yield page_n, file_name, time.time() - start_time
 
 
 def process_book(pdf_file, page_range, line_overlap,
@@ -167,22 +346,73 @@ def process_book(pdf_file, page_range, line_overlap,
                  word_margin,
                  boxes_flow):
     line_overlap = 0.5
-    source_dir = 'pdfs/'
-    book_name = pdf_file.replace('.pdf', '')
     laparams = LAParams(line_overlap, char_margin, line_margin, word_margin, boxes_flow)
-
-    with open(source_dir + pdf_file, 'r') as fp:
-        parser = PDFParser(fp)
-        document = PDFDocument(parser)
-        rsrcmgr = PDFResourceManager()
-        device = PDFPageAggregator(rsrcmgr, laparams=laparams)
-        interpreter = PDFPageInterpreter(rsrcmgr, device)
-
-        for page_n, page in enumerate(PDFPage.create_pages(document)):
-            if not page_range or (page_range[0] <= page_n <= page_range[1]):
-                interpreter.process_page(page)
-                layout = device.get_result()
-                write_image_file(layout, page_n, book_name, 'smaller_page_images', 0.66)
+    if page_range:
+        render_pages(pdf_file, page_range[0], page_range[1], laparams)
+    else:
+        render_pages(pdf_file, 0, None, laparams)
+
+
+def count_pages(pdf_path):
+    with open(pdf_path, 'rb') as fp:
+        document = PDFDocument(PDFParser(fp))
+        return sum(1 for _ in PDFPage.create_pages(document))
+
+
+def render_page_range_task(task):
+    """
+    Process pool entry point, renders one shard of pages.
+    :param task: (pdf_file, first_page, last_page, laparams args, source_dir, images_folder, scale_factor,
+    analyze_layout, scale_options)
+    :return: list of (book, page_n, seconds)
+    """
+    (pdf_file, first_page, last_page, laparams_args, source_dir, images_folder, scale_factor, analyze_layout,
+     scale_options) = task
+    page_timings = render_pages(pdf_file, first_page, last_page, LAParams(*laparams_args), source_dir,
+                                images_folder, scale_factor, analyze_layout, scale_options)
+    book_name = pdf_file.replace('.pdf', '')
+    return [(book_name, page_n, seconds) for page_n, seconds in page_timings]
+
+
+def process_books(pdf_files, page_ranges=None, n_processes=None, pages_per_task=20, line_overlap=0.5,
+                  char_margin=2.0, line_margin=0.5, word_margin=0.1, boxes_flow=0.5, source_dir='pdfs/',
+                  images_folder='smaller_page_images', scale_factor=0.66, analyze_layout=False, scale_options=None):
+    """
+    Renders the pages of one or more books across a pool of processes. Each book is split into shards of
+    pages_per_task pages, and each worker opens its own copy of the pdf to render its shard.
+    :param pdf_files: pdf file names, e.g. one group from load_book_info's breakdowns
+    :param page_ranges: optional book: [first_page, last_page] dict (inclusive, like process_book's page_range);
+    books without a range are rendered in full
+    :param n_processes: worker processes, defaults to the number of cpus
+    :param pages_per_task: pages per shard
+    :param analyze_layout: run pdfminer layout analysis to locate each page image, see render_pages
+    :param scale_options: resample, quality and draft options passed to scale_and_save_image
+    :return: list of (book, page_n, seconds spent rendering the page)
+    """
+    page_ranges = page_ranges or {}
+    laparams_args = (line_overlap, char_margin, line_margin, word_margin, boxes_flow)
+    tasks = []
+    for pdf_file in pdf_files:
+        book_range = page_ranges.get(pdf_file) or page_ranges.get(pdf_file.replace('.pdf', ''))
+        if book_range:
+            first_page, last_page = book_range[0], book_range[1]
+        else:
+            first_page, last_page = 0, count_pages(source_dir + pdf_file) - 1
+        for shard_start in range(first_page, last_page + 1, pages_per_task):
+            shard_end = min(shard_start + pages_per_task - 1, last_page)
+            tasks.append((pdf_file, shard_start, shard_end, laparams_args, source_dir, images_folder, scale_factor,
+                          analyze_layout, scale_options))
+
+    make_dirs(images_folder)
+    pool = Pool(n_processes)
+    try:
+        page_timings = []
+        for shard_timings in pool.imap_unordered(render_page_range_task, tasks):
+            page_timings.extend(shard_timings)
+    finally:
+        pool.close()
+        pool.join()
+    return sorted(page_timings)
 
 
 def assemble_url(page_number, book_name, base_url):
@@ -197,22 +427,311 @@ def check_response(url):
         return False
 
 
-def perform_ocr(pdf_file, annotation_dir, (start_n, stop_n)):
+def annotation_file_path(annotation_dir, book_name, page_n):
+    file_ext = ".json"
+    return annotation_dir + '/' + book_name + '_' + str(page_n) + file_ext
+
+
+def annotation_exists(annotation_dir, book_name, page_n, store=None):
+    """
+    :param store: optional annotation_store.AnnotationStore to look in instead of annotation_dir
+    :return: whether the page already has an annotation
+    """
+    if store is not None:
+        return store.get(book_name, page_n) is not None
+    return os.path.isfile(annotation_file_path(annotation_dir, book_name, page_n))
+
+
+def ocr_page_image(image_url, cache=None, image_path=None, max_retries=3, **query_params):
+    """
+    Queries the OCR service for one page image, through the cache when there is one, retrying connection errors,
+    throttling and server errors with backoff.
+    :param cache: optional ocr_cache.OCRCache, see query_vision_ocr_cached
+    :param image_path: local copy of the page image, see ocr_cache_key
+    :param query_params: passed to query_vision_ocr (debug, session, api_entry_point)
+    :return: OCR response json
+    """
+    if cache is not None:
+        return call_with_retry(query_vision_ocr_cached, (image_url, cache, image_path), query_params,
+                               max_retries=max_retries)
+    return call_with_retry(query_vision_ocr, (image_url,), query_params, max_retries=max_retries)
+
+
+def perform_ocr(pdf_file, annotation_dir, (start_n, stop_n), cache=None, images_folder=None):
     book_name = pdf_file.replace('.pdf', '')
 
-    base_url = 'https://s3-us-west-2.amazonaws.com/ai2-vision-turk-data/textbook-annotation-test/smaller-page-images/'
+    base_url = page_image_base_url
 
     page_n = start_n
     while page_n <= stop_n:
-        file_ext = ".json"
-        file_path = annotation_dir + '/' + book_name + '_' + str(page_n) + file_ext
-        if not os.path.isfile(file_path):
+        if not annotation_exists(annotation_dir, book_name, page_n):
 
             print(book_name, page_n)
             try:
                 print(assemble_url(page_n, book_name, base_url))
-                ocr_response = query_vision_ocr(assemble_url(page_n, book_name, base_url))
+                image_path = page_image_path(images_folder, book_name, page_n) if images_folder else None
+                ocr_response = ocr_page_image(assemble_url(page_n, book_name, base_url), cache, image_path,
+                                              max_retries=0)
                 write_annotation_file(ocr_response, page_n, book_name, annotation_dir)
-            except ValueError:
+            except (ValueError, requests.exceptions.HTTPError):
                 print('ocr service error')
         page_n += 1
+
+
+def make_ocr_session(pool_size):
+    """
+    Creates a requests session whose connection pool can hold one connection per concurrent request.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def perform_ocr_concurrently(pdf_file, annotation_dir, (start_n, stop_n), max_workers=8, max_retries=3,
+                             debug=False, base_url=page_image_base_url, api_entry_point=ocr_api_entry_point,
+                             store=None, cache=None, images_folder=None):
+    """
+    Like perform_ocr, but keeps up to max_workers OCR requests in flight over a pooled session.
+    Each page's annotation file is written as soon as its response arrives; pages that already have one are skipped.
+    :param pdf_file: book file name
+    :param annotation_dir: dir annotation files are written to
+    :param max_workers: number of concurrent OCR requests
+    :param max_retries: retries per page for connection errors, throttling and server errors, with backoff
+    :param debug: download and print each page image's size before querying, as query_vision_ocr does by default
+    :param store: optional annotation_store.AnnotationStore to write to instead of annotation_dir
+    :param cache: optional ocr_cache.OCRCache; cached pages make no service calls
+    :param images_folder: local page images, so cached responses are keyed by image content
+    :return: page_n: 'written', 'skipped' or the exception that stopped it
+    """
+    book_name = pdf_file.replace('.pdf', '')
+    session = make_ocr_session(max_workers)
+    query_params = {'debug': debug, 'session': session, 'api_entry_point': api_entry_point}
+
+    def ocr_page(page_n):
+        if annotation_exists(annotation_dir, book_name, page_n, store):
+            return page_n, 'skipped'
+        try:
+            image_path = page_image_path(images_folder, book_name, page_n) if images_folder else None
+            ocr_response = ocr_page_image(assemble_url(page_n, book_name, base_url), cache, image_path, max_retries,
+                                          **query_params)
+            write_annotation_file(ocr_response, page_n, book_name, annotation_dir, store)
+            return page_n, 'written'
+        except Exception as e:
+            return page_n, e
+
+    pool = ThreadPool(max_workers)
+    try:
+        return OrderedDict(sorted(pool.imap_unordered(ocr_page, range(start_n, stop_n + 1))))
+    finally:
+        pool.close()
+        session.close()
+
+
+def regenerate_annotations(pdf_file, annotation_dir, (start_n, stop_n), cache, images_folder=None,
+                           base_url=page_image_base_url, merge_boxes=False, include_merged_components=False,
+                           store=None):
+    """
+    Rewrites annotation files from cached OCR responses only, e.g. after the annotation format changes.
+    Never calls the OCR service; existing annotations are overwritten.
+    :param cache: ocr_cache.OCRCache filled by earlier perform_ocr runs
+    :param images_folder: local page images, if the responses were cached by image content
+    :return: page_n: 'written' or 'not cached'
+    """
+    book_name = pdf_file.replace('.pdf', '')
+    page_results = OrderedDict()
+    for page_n in range(start_n, stop_n + 1):
+        image_path = page_image_path(images_folder, book_name, page_n) if images_folder else None
+        ocr_response = cache.get(ocr_cache_key(assemble_url(page_n, book_name, base_url), image_path, merge_boxes,
+                                               include_merged_components))
+        if ocr_response is None:
+            page_results[page_n] = 'not cached'
+            continue
+        write_annotation_file(ocr_response, page_n, book_name, annotation_dir, store)
+        page_results[page_n] = 'written'
+    return page_results
+
+
+class StageMetrics(object):
+    """
+    Thread-safe throughput counters for one stage of run_streaming_pipeline.
+    """
+    def __init__(self, n_workers):
+        self.n_workers = n_workers
+        self.pages = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, busy_seconds, blocked_seconds=0.0, failed=False):
+        """
+        :param busy_seconds: time spent working on a page
+        :param blocked_seconds: time spent waiting for room in the next stage's queue (backpressure)
+        """
+        with self.lock:
+            self.pages += 1
+            self.errors += failed
+            self.busy_seconds += busy_seconds
+            self.blocked_seconds += blocked_seconds
+
+    def summary(self, elapsed):
+        with self.lock:
+            return OrderedDict([
+                ('workers', self.n_workers),
+                ('pages', self.pages),
+                ('errors', self.errors),
+                ('busy_seconds', self.busy_seconds),
+                ('blocked_seconds', self.blocked_seconds),
+                ('pages_per_second', self.pages / elapsed if elapsed else 0.0),
+                ('utilization', self.busy_seconds / (elapsed * self.n_workers) if elapsed else 0.0)
+            ])
+
+
+def run_streaming_pipeline(pdf_files, annotation_dir, page_ranges=None, source_dir='pdfs/',
+                           images_folder='smaller_page_images', scale_factor=0.66, scale_options=None,
+                           render_workers=1, ocr_workers=8, write_workers=2, queue_size=16, upload=None,
+                           base_url=page_image_base_url, api_entry_point=ocr_api_entry_point, max_retries=3,
+                           cache=None, store=None):
+    """
+    Renders, OCRs and writes annotations for whole books with every stage running at once: each page moves on as
+    soon as its image is written, instead of each stage finishing every book first.
+    Stages are connected by bounded queues, so a slow stage holds back the ones before it rather than letting pages
+    pile up. Pages that already have an annotation are skipped without rendering, so a stopped run can be resumed.
+    :param pdf_files: pdf file names
+    :param annotation_dir: dir annotation files are written to
+    :param page_ranges: optional book: [first_page, last_page] dict, see process_books
+    :param render_workers: books rendered at once, one thread per book. pdfminer is pure Python, so these threads
+    share one core: more than one only overlaps rendering with file I/O. When rendering is the bottleneck, render
+    the books across processes with process_books and OCR them with perform_ocr_concurrently instead.
+    :param ocr_workers: concurrent OCR requests
+    :param write_workers: threads writing annotations
+    :param queue_size: most pages waiting between two stages
+    :param upload: optional function of (image_path, book, page_n) that publishes a page image and returns the url
+    the OCR service should fetch. Without it, images are assumed to be served from base_url.
+    :param max_retries: retries per page for connection errors, throttling and server errors, with backoff
+    :param cache: optional ocr_cache.OCRCache, see perform_ocr_concurrently
+    :param store: optional annotation_store.AnnotationStore to write to instead of annotation_dir
+    :return: book: {page_n: 'written', 'skipped' or the exception that stopped it} dict, and a summary of
+    per-stage page metrics, with book_errors holding book: exception for books that could not be opened or stopped
+    rendering part way
+    """
+    page_ranges = page_ranges or {}
+    books = Queue()
+    ocr_queue = Queue(queue_size)
+    write_queue = Queue(queue_size)
+    session = make_ocr_session(ocr_workers)
+    metrics = OrderedDict([('render', StageMetrics(render_workers)), ('ocr', StageMetrics(ocr_workers)),
+                           ('write', StageMetrics(write_workers))])
+    page_results = defaultdict(dict)
+    book_errors = OrderedDict()
+    results_lock = threading.Lock()
+
+    def set_result(book_name, page_n, result):
+        with results_lock:
+            page_results[book_name][page_n] = result
+
+    def put_timed(queue, item):
+        start_time = time.time()
+        queue.put(item)
+        return time.time() - start_time
+
+    def render_books():
+        while True:
+            pdf_file = books.get()
+            if pdf_file is None:
+                return
+            book_name = pdf_file.replace('.pdf', '')
+            book_range = page_ranges.get(pdf_file) or page_ranges.get(book_name) or (0, None)
+
+            def skip_page(page_n):
+                if annotation_exists(annotation_dir, book_name, page_n, store):
+                    set_result(book_name, page_n, 'skipped')
+                    return True
+                return False
+
+            pages = iter_rendered_pages(pdf_file, book_range[0], book_range[1], None, source_dir, images_folder,
+                                        scale_factor, False, scale_options, skip_page)
+            while True:
+                start_time = time.time()
+                try:
+                    page_n, file_name, _ = next(pages)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    with results_lock:
+                        book_errors[book_name] = e
+                    break
+                busy_seconds = time.time() - start_time
+                blocked_seconds = put_timed(ocr_queue, (book_name, page_n, file_name))
+                metrics['render'].record(busy_seconds, blocked_seconds)
+
+    def ocr_pages():
+        query_params = {'debug': False, 'session': session, 'api_entry_point': api_entry_point}
+        while True:
+            page = ocr_queue.get()
+            if page is None:
+                return
+            book_name, page_n, file_name = page
+            start_time = time.time()
+            try:
+                image_path = os.path.join(images_folder, file_name) if file_name else None
+                if upload:
+                    image_url = upload(image_path, book_name, page_n)
+                else:
+                    image_url = assemble_url(page_n, book_name, base_url)
+                ocr_response = ocr_page_image(image_url, cache, image_path, max_retries, **query_params)
+            except Exception as e:
+                set_result(book_name, page_n, e)
+                metrics['ocr'].record(time.time() - start_time, failed=True)
+                continue
+            busy_seconds = time.time() - start_time
+            blocked_seconds = put_timed(write_queue, (book_name, page_n, ocr_response))
+            metrics['ocr'].record(busy_seconds, blocked_seconds)
+
+    def write_pages():
+        while True:
+            page = write_queue.get()
+            if page is None:
+                return
+            book_name, page_n, ocr_response = page
+            start_time = time.time()
+            try:
+                write_annotation_file(ocr_response, page_n, book_name, annotation_dir, store)
+                set_result(book_name, page_n, 'written')
+                metrics['write'].record(time.time() - start_time)
+            except Exception as e:
+                set_result(book_name, page_n, e)
+                metrics['write'].record(time.time() - start_time, failed=True)
+
+    def start_workers(target, n_workers):
+        workers = [threading.Thread(target=target) for _ in range(n_workers)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        return workers
+
+    if store is None:
+        make_dirs(annotation_dir)
+    make_dirs(images_folder)
+    start_time = time.time()
+    for pdf_file in pdf_files:
+        books.put(pdf_file)
+    stages = [(render_books, render_workers, books), (ocr_pages, ocr_workers, ocr_queue),
+              (write_pages, write_workers, write_queue)]
+    stage_workers = [(start_workers(target, n_workers), queue) for target, n_workers, queue in stages]
+    try:
+        for workers, queue in stage_workers:
+            for _ in workers:
+                queue.put(None)
+            for worker in workers:
+                worker.join()
+    finally:
+        session.close()
+    elapsed = time.time() - start_time
+
+    summary = OrderedDict([('elapsed_seconds', elapsed)])
+    summary['stages'] = OrderedDict((stage, stage_metrics.summary(elapsed)) for stage, stage_metrics in metrics.items())
+    summary['book_errors'] = book_errors
+    return {book: OrderedDict(sorted(results.items())) for book, results in page_results.items()}, summary
@@ -1,16 +1,32 @@
+import os
 import pickle
+import stat
+import tempfile
+import threading
+import time
 import boto
+import numpy as np
 import pandas as pd
 import json
 import jsonschema
-from collections import defaultdict
-from copy import deepcopy
+from collections import defaultdict, OrderedDict
+from multiprocessing.pool import ThreadPool
 import boto.mturk.connection as tc
 import boto.mturk.question as tq
 from boto.mturk.qualification import PercentAssignmentsApprovedRequirement, Qualifications, Requirement
 import requests
 
 from annotation_schema import page_schema
+from instrumentation import instrumented
+from review_actions import approve_operations, block_operations, disable_operations, reject_operations, \
+    run_review_operations
+from throttling import TokenBucket, call_with_retry, is_throttling_error
+
+try:
+    import ujson
+    fast_json_loads = ujson.loads
+except ImportError:
+    fast_json_loads = json.loads
 
 """
 This module defines several functions used in the example mechanical-turk jupyter notebook.
@@ -65,28 +81,59 @@ def make_book_group_urls(book_groups, book_group, ranges):
     return group_urls
 
 
+def build_qualifications():
+    """
+    Creates a single qualification that workers have a > 95% acceptance rate.
+    :return: boto qualification obj.
+    """
+    qualifications = Qualifications()
+    req1 = PercentAssignmentsApprovedRequirement(comparator="GreaterThan", integer_value="95")
+    qualifications.add(req1)
+    return qualifications
+
+
+class HITTemplate(object):
+    """
+    HIT params shared by every page in a batch. The qualifications and reward are built once and reused,
+    so stamping out params for a url only creates its ExternalQuestion.
+    """
+    def __init__(self, static_params):
+        """
+        :param static_params: Universal HIT params (set by user in notebook).
+        """
+        self.static_params = dict(static_params)
+        self.static_params['qualifications'] = build_qualifications()
+        self.static_params['reward'] = boto.mturk.price.Price(static_params['amount'])
+        self.frame_height = static_params['frame_height']
+
+    def hit_params(self, url):
+        """
+        :param url: formatted url of page image on s3
+        :return: complete HIT parameters.
+        """
+        hit_params = self.static_params.copy()
+        hit_params['questionform'] = tq.ExternalQuestion(url, self.frame_height)
+        return hit_params
+
+
+def as_hit_template(static_params):
+    """
+    :param static_params: Universal HIT params dict, or a HITTemplate built from them
+    :return: HITTemplate
+    """
+    if isinstance(static_params, HITTemplate):
+        return static_params
+    return HITTemplate(static_params)
+
+
 def build_hit_params(url, static_params):
     """
     Dynamically builds some HIT params that will change based on the book/url
     :param url: formatted url of page image on s3
-    :param static_params: Universal HIT params (set by user in notebook).
+    :param static_params: Universal HIT params (set by user in notebook), or a HITTemplate built from them.
     :return: complete HIT parameters.
     """
-    def build_qualifications():
-        """
-        Creates a single qualification that workers have a > 95% acceptance rate.
-        :return: boto qualification obj.
-        """
-        qualifications = Qualifications()
-        req1 = PercentAssignmentsApprovedRequirement(comparator="GreaterThan", integer_value="95")
-        qualifications.add(req1)
-        return qualifications
-    
-    hit_params = deepcopy(static_params)
-    hit_params['qualifications'] = build_qualifications()
-    hit_params['questionform'] = tq.ExternalQuestion(url, static_params['frame_height'])
-    hit_params['reward'] = boto.mturk.price.Price(hit_params['amount'])
-    return hit_params
+    return as_hit_template(static_params).hit_params(url)
 
 
 def create_single_hit(mturk_connection, url, static_hit_params):
@@ -94,7 +141,7 @@ def create_single_hit(mturk_connection, url, static_hit_params):
     Creates a single HIT from a provided url
     :param mturk_connection: active mturk connection established by user in the nb.
     :param url: page url for the HIT
-    :param static_hit_params: User-defined global HIT params
+    :param static_hit_params: User-defined global HIT params, or a HITTemplate built from them
     :return: boto create hit return as a status check
     """
     hit_params = build_hit_params(url, static_hit_params)
@@ -112,20 +159,60 @@ def create_single_hit(mturk_connection, url, static_hit_params):
     return create_hit_result
 
 
-def create_hits_from_pages(mturk_connection, page_links, static_hit_params):
-    for url in page_links:
-        create_single_hit(mturk_connection, url, static_hit_params)
-    
+def map_with_pool(func, items, max_workers):
+    """
+    Maps func over items, in order, from a thread pool when max_workers > 1.
+    """
+    if max_workers <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(max_workers)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+@instrumented(rows_in='page_links')
+def create_hits_from_pages(mturk_connection, page_links, static_hit_params, max_workers=1, max_per_second=None,
+                           max_retries=3):
+    """
+    Creates a HIT for each page url, optionally from a pool of threads sharing a rate limit.
+    Only throttled requests are retried with backoff: create_hit isn't idempotent, so retrying a request that timed
+    out or failed server-side could post a duplicate HIT.
+    :param mturk_connection: active mturk connection established by user in the nb.
+    :param page_links: page urls to create HITs for
+    :param static_hit_params: User-defined global HIT params, or a HITTemplate built from them
+    :param max_workers: number of HITs created concurrently
+    :param max_per_second: cap on create_hit requests per second across all workers
+    :param max_retries: retries per HIT for throttled requests
+    :return: url: HIT id dict, holding the exception instead for urls whose HIT could not be created
+    """
+    hit_template = as_hit_template(static_hit_params)
+    rate_limiter = TokenBucket(max_per_second) if max_per_second else None
+
+    def create_hit_for_url(url):
+        try:
+            create_hit_result = call_with_retry(create_single_hit, (mturk_connection, url, hit_template),
+                                                max_retries=max_retries, rate_limiter=rate_limiter,
+                                                is_retryable=is_throttling_error)
+            return url, create_hit_result[0].HITId
+        except Exception as e:
+            return url, e
 
-def delete_all_hits(mturk_connection):
+    return OrderedDict(map_with_pool(create_hit_for_url, page_links, max_workers))
+
+
+
+def delete_all_hits(mturk_connection, **review_params):
     """
     Permanently disables/ deletes all of the users active HITs.
     :param mturk_connection: active mturk connection established by user in the nb.
-    :return:
+    :param review_params: passed to review_actions.run_review_operations (journal, max_workers, max_per_second...)
+    :return: summary of the operations, see review_actions.run_review_operations
     """
     my_hits = list(mturk_connection.get_all_hits())
-    for hit in my_hits:
-        mturk_connection.disable_hit(hit.HITId)
+    return run_review_operations(mturk_connection, disable_operations(hit.HITId for hit in my_hits), **review_params)
 
 
 def count_pages_in_df(any_result_df):
@@ -136,72 +223,204 @@ def count_pages_with_cat(consensus_df, category):
     return len(pd.unique(consensus_df[consensus_df['category'] == category]['page']))
 
 
-def delete_some_hits(mturk_connection, hit_ids):
-    for hit in hit_ids.keys():
-        mturk_connection.disable_hit(hit)
+def delete_some_hits(mturk_connection, hit_ids, **review_params):
+    return run_review_operations(mturk_connection, disable_operations(hit_ids.keys()), **review_params)
+
 
+class HarvestProgress(object):
+    """
+    Thread-safe progress and throughput counters for get_completed_hits and get_assignments.
+    """
+    def __init__(self):
+        self.hits_done = 0
+        self.assignments_fetched = 0
+        self.requests = 0
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, hits=0, assignments=0, requests=0):
+        with self.lock:
+            self.hits_done += hits
+            self.assignments_fetched += assignments
+            self.requests += requests
 
-def get_completed_hits(mturk_connection):
+    def summary(self):
+        """
+        :return: dict of counts, elapsed seconds and per-second rates
+        """
+        with self.lock:
+            elapsed = time.time() - self.start_time
+            return {
+                'hits_done': self.hits_done,
+                'assignments_fetched': self.assignments_fetched,
+                'requests': self.requests,
+                'elapsed_seconds': elapsed,
+                'hits_per_second': self.hits_done / elapsed if elapsed else 0.0,
+                'requests_per_second': self.requests / elapsed if elapsed else 0.0
+            }
+
+
+@instrumented()
+def get_completed_hits(mturk_connection, max_workers=1, page_size=100, max_per_second=None, max_retries=3,
+                       progress=None):
     """
     Queries amt for all active user HITs.
+    After the first page, the remaining pages of reviewable HITs are fetched concurrently when max_workers > 1.
     :param mturk_connection: active mturk connection established by user in the nb.
+    :param max_workers: number of pages fetched concurrently
+    :param page_size: HITs per page (100 is the most amt allows)
+    :param max_per_second: cap on requests per second across all workers
+    :param max_retries: retries per request for throttled or transient errors
+    :param progress: optional HarvestProgress to update
     :return: list of boto HIT result objects
     """
+    rate_limiter = TokenBucket(max_per_second) if max_per_second else None
+    progress = progress or HarvestProgress()
+
+    def get_hit_page(page_n):
+        hit_range = call_with_retry(mturk_connection.get_reviewable_hits,
+                                    kwargs={'page_size': page_size, 'page_number': page_n},
+                                    max_retries=max_retries, rate_limiter=rate_limiter)
+        progress.record(requests=1)
+        return hit_range
+
     reviewable_hits = []
+    hit_range = get_hit_page(1)
+    reviewable_hits.extend(hit_range)
+    if hasattr(hit_range, 'TotalNumResults'):
+        total_records = int(hit_range.TotalNumResults)
+        remaining_pages = range(2, total_records // page_size + bool(total_records % page_size) + 1)
+        for hit_range in map_with_pool(get_hit_page, remaining_pages, max_workers):
+            reviewable_hits.extend(hit_range)
+    else:
+        page_n = 2
+        while hit_range:
+            hit_range = get_hit_page(page_n)
+            reviewable_hits.extend(hit_range)
+            page_n += 1
+    return reviewable_hits
+
+
+def get_hit_assignments(mturk_connection, hit_id, status=None, page_size=100, max_retries=3, rate_limiter=None,
+                        progress=None):
+    """
+    Retrieves every assignment for a single HIT, following pagination.
+    :param mturk_connection: active mturk connection established by user in the nb.
+    :param hit_id: HIT to retrieve assignments for
+    :param status: assignment status to filter by.
+    :param page_size: assignments per page (100 is the most amt allows)
+    :return: list of boto assignment objects
+    """
+    hit_assignments = []
     page_n = 1
-    hits_left = True
-    while hits_left:
-        hit_range = mturk_connection.get_reviewable_hits(page_size=100, page_number=page_n)
-        if not hit_range:
-            hits_left = False
-            break
-        reviewable_hits.extend(hit_range)
+    while True:
+        assignment_page = call_with_retry(mturk_connection.get_assignments, (hit_id,),
+                                          {'status': status, 'page_size': page_size, 'page_number': page_n},
+                                          max_retries=max_retries, rate_limiter=rate_limiter)
+        hit_assignments.extend(assignment_page)
+        if progress:
+            progress.record(assignments=len(assignment_page), requests=1)
+        total_records = int(getattr(assignment_page, 'TotalNumResults', len(hit_assignments)))
+        if not assignment_page or len(hit_assignments) >= total_records:
+            return hit_assignments
         page_n += 1
-    return reviewable_hits
 
 
-def get_assignments(mturk_connection, reviewable_hits, status=None):
+@instrumented(rows_in='reviewable_hits')
+def get_assignments(mturk_connection, reviewable_hits, status=None, max_workers=1, page_size=100,
+                    max_per_second=None, max_retries=3, progress=None):
     """
     Retrieves individual assignments associated with the specified HITs.
+    HITs are fetched concurrently when max_workers > 1, and results are added to the dict as each HIT finishes.
     :param mturk_connection: active mturk connection established by user in the nb.
     :param reviewable_hits: HITs to review
     :param status: HIT status to filter by.
+    :param max_workers: number of HITs fetched concurrently
+    :param page_size: assignments per request (100 is the most amt allows)
+    :param max_per_second: cap on requests per second across all workers
+    :param max_retries: retries per request for throttled or transient errors
+    :param progress: optional HarvestProgress to update, e.g. from another thread
     :return: hit_id:assignment dict
     """
+    rate_limiter = TokenBucket(max_per_second) if max_per_second else None
+    progress = progress or HarvestProgress()
+
+    def fetch_hit(hit):
+        hit_assignments = get_hit_assignments(mturk_connection, hit.HITId, status, page_size, max_retries,
+                                              rate_limiter, progress)
+        progress.record(hits=1)
+        return hit.HITId, hit_assignments
+
     assignments = defaultdict(list)
-    for hit in reviewable_hits:
-        assignment = mturk_connection.get_assignments(hit.HITId, status=status)
-        assignments[hit.HITId].extend(assignment)
+    if max_workers <= 1:
+        for hit_id, hit_assignments in (fetch_hit(hit) for hit in reviewable_hits):
+            assignments[hit_id].extend(hit_assignments)
+        return assignments
+    pool = ThreadPool(max_workers)
+    try:
+        for hit_id, hit_assignments in pool.imap_unordered(fetch_hit, reviewable_hits):
+            assignments[hit_id].extend(hit_assignments)
+    finally:
+        pool.terminate()
+        pool.join()
     return assignments
 
 
-def process_raw_hits(assignments_by_hit):
+def iter_assignment_answers(assignments_by_hit, fast_json=True):
     """
-    Extracts assignment results from boto assignment objects in a more convienent form.
-    :param assignments_by_hit: dict of boto assignment objects.
-    :return: A nested dict with the box_id:assigned labels at the lowest level.
+    Lazily decodes assignment results from boto assignment objects, one submitted page at a time.
+    :param assignments_by_hit: dict of boto assignment objects, or an iterable of (hit_id, assignments) pairs.
+    :param fast_json: decode with ujson when it is installed
+    :return: generator of (hit_id, assignment_id, page, boxes) with the worker_id set on each box
     """
-    mechanical_turk_results = defaultdict(list)
-    for hit_id, hit_assignments in assignments_by_hit.items():
+    json_loads = fast_json_loads if fast_json else json.loads
+    hit_items = assignments_by_hit.items() if hasattr(assignments_by_hit, 'items') else assignments_by_hit
+    for hit_id, hit_assignments in hit_items:
         for assignment in hit_assignments:
             for answers in assignment.answers:
-                box_result = answers[1].fields[0]
-                box_json = json.loads(box_result)
+                box_json = json_loads(answers[1].fields[0])
                 for box in box_json:
                     box['worker_id'] = assignment.WorkerId
-                mechanical_turk_results[hit_id].append({
-                    assignment.AssignmentId: {answers[0].fields[0]: box_json}}
-                )
+                yield hit_id, assignment.AssignmentId, answers[0].fields[0], box_json
+
+
+def iter_box_records(assignments_by_hit, fast_json=True):
+    """
+    Streams flat box records out of boto assignment objects without holding the whole batch's results.
+    :param assignments_by_hit: dict of boto assignment objects, or an iterable of (hit_id, assignments) pairs.
+    :param fast_json: decode with ujson when it is installed
+    :return: generator of box dicts, each with hit_id, assignment_id, page and worker_id added
+    """
+    for hit_id, a_id, page, boxes in iter_assignment_answers(assignments_by_hit, fast_json):
+        for box in boxes:
+            box['hit_id'] = hit_id
+            box['assignment_id'] = a_id
+            box['page'] = page
+            yield box
+
+
+@instrumented(rows_in='assignments_by_hit')
+def process_raw_hits(assignments_by_hit, fast_json=False):
+    """
+    Extracts assignment results from boto assignment objects in a more convienent form.
+    :param assignments_by_hit: dict of boto assignment objects.
+    :param fast_json: decode with ujson when it is installed
+    :return: A nested dict with the box_id:assigned labels at the lowest level.
+    """
+    mechanical_turk_results = defaultdict(list)
+    for hit_id, a_id, page, boxes in iter_assignment_answers(assignments_by_hit, fast_json):
+        mechanical_turk_results[hit_id].append({a_id: {page: boxes}})
     return mechanical_turk_results
 
 
-def accept_hits(mturk_connection, assignments_to_approve):
-    for hit_id, hit_assignments in assignments_to_approve.items():
-        for assignment in hit_assignments:
-            if assignment.AssignmentStatus == 'Submitted':
-                mturk_connection.approve_assignment(assignment.AssignmentId)
-            else:
-                print assignment.AssignmentStatus
+def accept_hits(mturk_connection, assignments_to_approve, **review_params):
+    """
+    Approves every submitted assignment.
+    :param assignments_to_approve: hit_id: [boto assignment] dict
+    :param review_params: passed to review_actions.run_review_operations (journal, max_workers, max_per_second...)
+    :return: summary of the operations, see review_actions.run_review_operations
+    """
+    return run_review_operations(mturk_connection, approve_operations(assignments_to_approve), **review_params)
 
 
 def match_workers_assignments(worker_list, worker_result_df):
@@ -215,29 +434,34 @@ def match_workers_assignments(worker_list, worker_result_df):
     return pd.unique(match_df['assignment_id']).tolist(), pd.unique(match_df['worker_id']).tolist()
 
 
-def reject_assignments(mturk_connection, workers_to_reject, worker_result_df):
-    feedback_message = """
-    Your HITs contained many incomplete or incorrect pages.
+def reject_assignments(mturk_connection, workers_to_reject, worker_result_df, **review_params):
+    """
+    Rejects every assignment submitted by the given workers. Assignments that were already approved or rejected are
+    reported and otherwise ignored.
+    :param review_params: passed to review_actions.run_review_operations (journal, max_workers, max_per_second...)
+    :return: number of assignments and number of workers matched
+    :raises RuntimeError: if any rejection failed, listing the failures. With a journal, rerunning retries only
+    those.
     """
     assignments_to_reject, workers_rejected = match_workers_assignments(workers_to_reject, worker_result_df)
     reject_count = len(assignments_to_reject)
     worker_count = len(workers_rejected)
-    for assignment_id in assignments_to_reject:
-        try:
-            mturk_connection.reject_assignment(assignment_id, feedback_message)
-        except boto.mturk.connection.MTurkRequestError:
-            print 'assignment ' + str(assignment_id) + ' already accepted or rejected'
+    summary = run_review_operations(mturk_connection, reject_operations(assignments_to_reject), **review_params)
+    for _, assignment_id, _ in summary['conflicts']:
+        print 'assignment ' + str(assignment_id) + ' already accepted or rejected'
+    if summary['failures']:
+        raise RuntimeError(str(len(summary['failures'])) + ' of ' + str(reject_count) +
+                           ' rejections failed: ' + str(summary['failures']))
 
     return reject_count, worker_count
 
 
-def ban_bad_workers(mturk_connection, worker_ids):
-    for worker in worker_ids:
-        reason_for_block = """
-        Worker's submissions were largely incomplete.
-        """
-        print 'blocking ' + str(worker)
-        mturk_connection.block_worker(worker, reason_for_block)
+def ban_bad_workers(mturk_connection, worker_ids, **review_params):
+    """
+    :param review_params: passed to review_actions.run_review_operations (journal, max_workers, max_per_second...)
+    :return: summary of the operations, see review_actions.run_review_operations
+    """
+    return run_review_operations(mturk_connection, block_operations(worker_ids), **review_params)
 
 
 def get_assignment_statuses(assignment_results):
@@ -249,98 +473,360 @@ def get_assignment_statuses(assignment_results):
     return status_series.value_counts()
 
 
-def make_results_df(raw_hit_results):
+RESULT_COLUMNS = ['page', 'category', 'hit_id', 'assignment_id', 'box_id', 'worker_id']
+CATEGORICAL_RESULT_COLUMNS = ['page', 'category', 'hit_id', 'worker_id']
+
+
+def iter_processed_answers(raw_hit_results):
     """
-    Creates a pandas dataframe from processed HIT results.
-    NOTE- the way I do this with pandas is not efficient, despite setting the new rows by loc.
-    Profiling this function pointed a finger at pandas, but I need to investigate further.
-    :param raw_hit_results:  results dict processed using the process_raw_hits function above
-    :return: text-box level results in a pandas dataframe
+    :param raw_hit_results: results dict processed using the process_raw_hits function above
+    :return: generator of (hit_id, assignment_id, page, boxes)
     """
-    col_names = ['page', 'category', 'hit_id', 'assignment_id', 'box_id', 'worker_id']
-    results_df = pd.DataFrame(columns=col_names)
     for hit_id, assignments in raw_hit_results.items():
         for assignment in assignments:
             for a_id, annotation in assignment.items():
                 for page, labeled_text in annotation.items():
-                    for box in labeled_text:
-                        results_df.loc[len(results_df)] = \
-                            [page, box['category'], hit_id, a_id, box['id'], box['worker_id']]
-    return results_df
+                    yield hit_id, a_id, page, labeled_text
+
+
+def flatten_hit_results(answers, include_group_n=False):
+    """
+    Streams labeled pages into per-column lists, one entry per labeled box.
+    :param answers: iterable of (hit_id, assignment_id, page, boxes), see iter_processed_answers and
+    iter_assignment_answers
+    :param include_group_n: adds a group_n column (0 when a box has no question group)
+    :return: dict of column name: list of values
+    """
+    col_names = RESULT_COLUMNS + ['group_n'] if include_group_n else RESULT_COLUMNS
+    columns = {col: [] for col in col_names}
+    pages, categories, hit_ids, a_ids, box_ids, worker_ids = [columns[col] for col in RESULT_COLUMNS]
+    group_ns = columns.get('group_n')
+    for hit_id, a_id, page, labeled_text in answers:
+        for box in labeled_text:
+            pages.append(page)
+            categories.append(box['category'])
+            hit_ids.append(hit_id)
+            a_ids.append(a_id)
+            box_ids.append(box['id'])
+            worker_ids.append(box['worker_id'])
+            if include_group_n:
+                group_ns.append(str(box.get('group_n', 0)))
+    return columns
+
+
+def results_df_from_columns(columns, include_group_n, categorical):
+    """
+    Builds the results dataframe from the column lists made by flatten_hit_results.
+    """
+    col_names = RESULT_COLUMNS + ['group_n'] if include_group_n else RESULT_COLUMNS
+    if categorical:
+        for col in CATEGORICAL_RESULT_COLUMNS:
+            columns[col] = pd.Categorical(columns[col])
+    return pd.DataFrame(columns, columns=col_names)
+
+
+def build_results_df(raw_hit_results, include_group_n=False, categorical=True):
+    """
+    Creates a pandas dataframe from processed HIT results, building every column in one pass.
+    :param raw_hit_results: results dict processed using the process_raw_hits function above
+    :param include_group_n: adds a group_n column for the question annotation task
+    :param categorical: store page, category, hit_id and worker_id as pandas categoricals
+    :return: text-box level results in a pandas dataframe
+    """
+    columns = flatten_hit_results(iter_processed_answers(raw_hit_results), include_group_n)
+    return results_df_from_columns(columns, include_group_n, categorical)
 
 
-def make_question_results_df(raw_hit_results):
+@instrumented(rows_in='assignments_by_hit')
+def make_results_df_from_assignments(assignments_by_hit, include_group_n=False, categorical=True, fast_json=True):
+    """
+    Creates the results dataframe straight from boto assignment objects, decoding one page at a time instead of
+    building process_raw_hits' nested dict first.
+    :param assignments_by_hit: dict of boto assignment objects, or an iterable of (hit_id, assignments) pairs.
+    :param include_group_n: adds a group_n column for the question annotation task
+    :param categorical: store page, category, hit_id and worker_id as pandas categoricals
+    :param fast_json: decode with ujson when it is installed
+    :return: text-box level results in a pandas dataframe
+    """
+    columns = flatten_hit_results(iter_assignment_answers(assignments_by_hit, fast_json), include_group_n)
+    return results_df_from_columns(columns, include_group_n, categorical)
+
+
+@instrumented(rows_in='raw_hit_results')
+def make_results_df(raw_hit_results, categorical=True):
+    """
+    Creates a pandas dataframe from processed HIT results.
+    :param raw_hit_results:  results dict processed using the process_raw_hits function above
+    :param categorical: store page, category, hit_id and worker_id as pandas categoricals
+    :return: text-box level results in a pandas dataframe
+    """
+    return build_results_df(raw_hit_results, include_group_n=False, categorical=categorical)
+
+
+@instrumented(rows_in='raw_hit_results')
+def make_question_results_df(raw_hit_results, categorical=True):
     """
     similar to above with a new column for question group
     """
-    col_names = ['page', 'category', 'hit_id', 'assignment_id', 'box_id', 'worker_id', 'group_n']
-    results_df = pd.DataFrame(columns=col_names)
-    for hit_id, assignments in raw_hit_results.items():
-        for assignment in assignments:
-            for a_id, annotation in assignment.items():
-                for page, labeled_text in annotation.items():
-                    for box in labeled_text:
-                        if 'group_n' in box.keys():
-                            group_n = box['group_n']
-                        else:
-                            group_n = 0
-                        results_df.loc[len(results_df)] = \
-                            [page, box['category'], hit_id, a_id, box['id'], box['worker_id'], str(group_n)]
-    return results_df
+    return build_results_df(raw_hit_results, include_group_n=True, categorical=categorical)
 
 
-def make_consensus_df(results_df, no_consensus_flag):
+def harvest_new_results(mturk_connection, checkpoint_store, status=None, include_group_n=True, **harvest_params):
     """
-    Computes consensus labels from turker responses.
-    :param results_df: result dataframe generated by the above function.
-    :param no_consensus_flag: value to fill in for boxes without consensus.
-    :return: consensus results
+    Harvests reviewable HITs, parsing only assignments the checkpoint store hasn't seen (or whose status changed),
+    and appends their rows to the store's persisted results table.
+    :param mturk_connection: active mturk connection established by user in the nb.
+    :param checkpoint_store: checkpoint_store.CheckpointStore
+    :param status: assignment status to filter by.
+    :param include_group_n: build question results, with a group_n column
+    :param harvest_params: max_workers, max_per_second etc. passed to get_completed_hits and get_assignments
+    :return: results dataframe of only the newly processed assignments
+    """
+    reviewable_hits = get_completed_hits(mturk_connection, **harvest_params)
+    assignments = get_assignments(mturk_connection, reviewable_hits, status, **harvest_params)
+    new_assignments = checkpoint_store.new_or_changed(assignments)
+    new_results_df = make_results_df_from_assignments(new_assignments, include_group_n)
+    checkpoint_store.append_results(new_results_df, new_assignments)
+    checkpoint_store.record_assignments(new_assignments)
+    return new_results_df
+
+
+def group_box_votes(results_df):
     """
-    grouped_by_page = results_df.groupby(['page', 'box_id'])
-    aggregated_df = grouped_by_page.agg(pd.DataFrame.mode)
-    aggregated_df.drop(['assignment_id', 'page', 'box_id', 'worker_id'], axis=1, inplace=True)
-    aggregated_df = aggregated_df.fillna(no_consensus_flag)
-    consensus_results_df = aggregated_df.reset_index()
-    consensus_results_df.drop('level_2', axis=1, inplace=True)
-    return consensus_results_df
+    Assigns every vote an integer code for its (page, box_id) group, ordered the same way as groupby sorts them.
+    :param results_df: result dataframe generated by the above function.
+    :return: group code per row, page per group, box_id per group
+    """
+    page_codes, pages = pd.factorize(results_df['page'], sort=True)
+    box_codes, box_ids = pd.factorize(results_df['box_id'], sort=True)
+    page_box_codes = page_codes.astype(np.int64) * len(box_ids) + box_codes
+    group_codes, page_box_keys = pd.factorize(page_box_codes, sort=True)
+    group_pages = np.asarray(pages)[page_box_keys // len(box_ids)]
+    group_box_ids = np.asarray(box_ids)[page_box_keys % len(box_ids)]
+    return group_codes, group_pages, group_box_ids
+
+
+def count_modal_votes(group_codes, n_groups, values):
+    """
+    Finds the most common value in each group with a single sort over (group, value) pairs.
+    Ties go to the first value in sorted order, the same one pandas' mode lists first.
+    :param group_codes: integer group code per vote
+    :param n_groups: number of groups
+    :param values: the vote for each row
+    :return: modal value per group, votes for it, and whether another value received as many votes
+    """
+    value_codes, uniques = pd.factorize(values, sort=True)
+    n_values = max(len(uniques), 1)
+    voted = value_codes >= 0
+    pairs, pair_counts = np.unique(group_codes[voted].astype(np.int64) * n_values + value_codes[voted],
+                                   return_counts=True)
+    pair_groups = pairs // n_values
+    order = np.lexsort((-pair_counts, pair_groups))
+    sorted_groups = pair_groups[order]
+    sorted_counts = pair_counts[order]
+    sorted_values = (pairs % n_values)[order]
+
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]) if len(pairs) else \
+        np.array([], dtype=np.int64)
+    runner_up = np.minimum(starts + 1, max(len(pairs) - 1, 0))
+    has_tie = (starts + 1 < len(pairs)) & (sorted_groups[runner_up] == sorted_groups[starts]) & \
+        (sorted_counts[runner_up] == sorted_counts[starts])
+
+    modal_codes = np.full(n_groups, -1, dtype=np.int64)
+    top_votes = np.zeros(n_groups, dtype=np.int64)
+    ties = np.zeros(n_groups, dtype=bool)
+    modal_codes[sorted_groups[starts]] = sorted_values[starts]
+    top_votes[sorted_groups[starts]] = sorted_counts[starts]
+    ties[sorted_groups[starts]] = has_tie
+    modal_values = np.asarray(uniques, dtype=object)[np.maximum(modal_codes, 0)] if len(uniques) else \
+        np.empty(n_groups, dtype=object)
+    return modal_values, top_votes, ties | (modal_codes < 0)
+
+
+def estimate_worker_reliability(group_codes, worker_codes, label_codes, n_groups, n_workers, n_labels,
+                                max_iter=50, tol=1e-4, smoothing=1.0):
+    """
+    Jointly estimates each worker's accuracy and each box's label distribution with EM, under a one-coin
+    Dawid-Skene model: a worker gives the true label with probability equal to their accuracy, and otherwise
+    picks uniformly among the other labels. Starts from the majority vote.
+    :param group_codes: integer box code per vote
+    :param worker_codes: integer worker code per vote
+    :param label_codes: integer label code per vote
+    :param max_iter: most EM iterations to run
+    :param tol: stop once no box's posterior changes by more than this
+    :param smoothing: beta prior pseudo-counts on each worker's accuracy, so workers with few votes stay near 0.5
+    :return: accuracy per worker, n_groups x n_labels posterior label probabilities, iterations run
+    """
+    if not n_groups:
+        return np.full(n_workers, 0.5), np.zeros((0, n_labels)), 0
+    pair_codes = group_codes.astype(np.int64) * n_labels + label_codes
+    vote_counts = np.bincount(pair_codes, minlength=n_groups * n_labels).reshape(n_groups, n_labels)
+    posteriors = vote_counts / np.maximum(vote_counts.sum(axis=1, keepdims=True), 1).astype(float)
+    worker_votes = np.bincount(worker_codes, minlength=n_workers).astype(float)
+
+    accuracy = np.full(n_workers, 0.5)
+    iteration = 0
+    for iteration in range(1, max_iter + 1):
+        vote_right = posteriors[group_codes, label_codes]
+        accuracy = (np.bincount(worker_codes, weights=vote_right, minlength=n_workers) + smoothing) / \
+            (worker_votes + 2 * smoothing)
+        accuracy = np.clip(accuracy, 1e-6, 1 - 1e-6)
+        priors = np.maximum(posteriors.mean(axis=0), 1e-6)
+
+        log_right = np.log(accuracy)[worker_codes]
+        log_wrong = np.log((1 - accuracy) / max(n_labels - 1, 1))[worker_codes]
+        log_posteriors = np.log(priors)[np.newaxis, :] + \
+            np.bincount(group_codes, weights=log_wrong, minlength=n_groups)[:, np.newaxis] + \
+            np.bincount(pair_codes, weights=log_right - log_wrong,
+                        minlength=n_groups * n_labels).reshape(n_groups, n_labels)
+        log_posteriors -= log_posteriors.max(axis=1, keepdims=True)
+        new_posteriors = np.exp(log_posteriors)
+        new_posteriors /= new_posteriors.sum(axis=1, keepdims=True)
+        converged = np.abs(new_posteriors - posteriors).max() < tol
+        posteriors = new_posteriors
+        if converged:
+            break
+    return accuracy, posteriors, iteration
 
 
+@instrumented(rows_in='results_df')
+def make_consensus_df(results_df, no_consensus_flag, method='majority', **weighting_params):
+    """
+    Computes consensus labels from turker responses.
+    Boxes whose most common label is tied with another are given the no_consensus_flag.
+    :param results_df: result dataframe generated by the above function.
+    :param no_consensus_flag: value to fill in for boxes without consensus.
+    :param method: 'majority' for a plain vote, or 'weighted' to weight votes by estimated worker reliability,
+    see make_weighted_consensus_df
+    :param weighting_params: passed to make_weighted_consensus_df
+    :return: consensus results, with the number of votes, share of votes for the consensus label and tie flag per box
+    """
+    if method == 'weighted':
+        return make_weighted_consensus_df(results_df, no_consensus_flag, **weighting_params)
+    if method != 'majority':
+        raise ValueError('unknown consensus method: ' + str(method))
+    group_codes, group_pages, group_box_ids = group_box_votes(results_df)
+    n_groups = len(group_pages)
+    vote_count = np.bincount(group_codes, minlength=n_groups)
+
+    consensus_results = OrderedDict([('page', group_pages), ('box_id', group_box_ids)])
+    label_cols = [col for col in results_df.columns if col not in ['assignment_id', 'page', 'box_id', 'worker_id']]
+    for col in label_cols:
+        modal_values, top_votes, ties = count_modal_votes(group_codes, n_groups, results_df[col])
+        modal_values[ties] = no_consensus_flag
+        consensus_results[col] = modal_values
+        if col == 'category':
+            category_votes, category_ties = top_votes, ties
+    consensus_results['vote_count'] = vote_count
+    consensus_results['agreement'] = category_votes / vote_count.astype(float)
+    consensus_results['tie'] = category_ties
+    return pd.DataFrame(consensus_results)
+
+
+def make_weighted_consensus_df(results_df, no_consensus_flag, min_confidence=0.0, include_posteriors=False,
+                               max_iter=50, tol=1e-4, smoothing=1.0):
+    """
+    Computes consensus categories by weighting every vote with its worker's reliability, estimated with EM over
+    the whole batch (see estimate_worker_reliability), so a single unreliable worker no longer ties a box.
+    Other label columns (hit_id, group_n) still take the majority vote.
+    :param results_df: result dataframe generated by the above function.
+    :param no_consensus_flag: value to fill in for boxes without consensus.
+    :param min_confidence: boxes whose most probable category has a lower posterior are given the no_consensus_flag
+    :param include_posteriors: add a posterior_<category> column per category
+    :return: the same columns as make_consensus_df, plus confidence (posterior of the consensus category)
+    """
+    group_codes, group_pages, group_box_ids = group_box_votes(results_df)
+    n_groups = len(group_pages)
+    vote_count = np.bincount(group_codes, minlength=n_groups)
+    worker_codes, workers = pd.factorize(results_df['worker_id'])
+    label_codes, labels = pd.factorize(results_df['category'], sort=True)
+    n_labels = len(labels)
+    _, posteriors, _ = estimate_worker_reliability(group_codes, worker_codes, label_codes, n_groups, len(workers),
+                                                   n_labels, max_iter, tol, smoothing)
+
+    best_codes = posteriors.argmax(axis=1) if n_labels else np.zeros(n_groups, dtype=np.int64)
+    confidence = posteriors[np.arange(n_groups), best_codes] if n_labels else np.zeros(n_groups)
+    runner_up = np.sort(posteriors, axis=1)[:, -2] if n_labels > 1 else np.zeros(n_groups)
+    ties = np.isclose(confidence, runner_up) | (confidence < min_confidence)
+    best_votes = np.bincount(group_codes[label_codes == best_codes[group_codes]], minlength=n_groups)
+
+    consensus_results = OrderedDict([('page', group_pages), ('box_id', group_box_ids)])
+    label_cols = [col for col in results_df.columns if col not in ['assignment_id', 'page', 'box_id', 'worker_id']]
+    for col in label_cols:
+        if col == 'category':
+            modal_values = np.asarray(labels, dtype=object)[best_codes] if n_labels else \
+                np.empty(n_groups, dtype=object)
+            modal_values[ties] = no_consensus_flag
+        else:
+            modal_values, _, col_ties = count_modal_votes(group_codes, n_groups, results_df[col])
+            modal_values[col_ties] = no_consensus_flag
+        consensus_results[col] = modal_values
+    consensus_results['vote_count'] = vote_count
+    consensus_results['agreement'] = best_votes / vote_count.astype(float)
+    consensus_results['tie'] = ties
+    consensus_results['confidence'] = confidence
+    if include_posteriors:
+        for label_n, label in enumerate(labels):
+            consensus_results['posterior_' + str(label)] = posteriors[:, label_n]
+    return pd.DataFrame(consensus_results)
+
+
+@instrumented(rows_in='combined_results_df')
 def make_consensus_df_w_worker_id(combined_results_df, combined_consensus_results_df):
     """
     Adds worker-level information to the consensus results
     :param combined_results_df: results dataframe
     :param combined_consensus_results_df: consensus results dataframe.
-    :return:
+    :return: every worker's row from the results, ordered by (hit_id, box_id), with the box's consensus_category
+    and the box's consensus stats (vote_count, agreement, tie and, for weighted consensus, confidence and posteriors)
     """
-    consensus_with_worker_id_df = pd.DataFrame(columns=list(combined_consensus_results_df.columns) + ['worker_id', 'consensus_category'])
-    for hitbox_id, rows in combined_results_df.groupby(['hit_id', 'box_id']):
-        this_consensus_row = combined_consensus_results_df[
-            (combined_consensus_results_df['hit_id'] == hitbox_id[0]) & (combined_consensus_results_df['box_id'] == hitbox_id[1])]
-        new_rows = rows.copy()
-        new_rows['consensus_category'] = this_consensus_row['category'].values[0]
-        consensus_with_worker_id_df = consensus_with_worker_id_df.append(new_rows)
-    return consensus_with_worker_id_df
+    def hit_box_index(any_df):
+        return pd.MultiIndex.from_arrays([np.asarray(any_df[col], dtype=object) for col in ['hit_id', 'box_id']])
+
+    unique_consensus_df = combined_consensus_results_df.drop_duplicates(['hit_id', 'box_id'])
+    box_stat_cols = [col for col in unique_consensus_df.columns if col not in combined_results_df.columns]
+    box_consensus_df = unique_consensus_df[box_stat_cols].copy()
+    box_consensus_df['consensus_category'] = unique_consensus_df['category'].values
+    box_consensus_df.index = hit_box_index(unique_consensus_df)
+    matched_df = box_consensus_df.reindex(hit_box_index(combined_results_df))
+    consensus_with_worker_id_df = combined_results_df.copy()
+    for col in matched_df.columns:
+        consensus_with_worker_id_df[col] = matched_df[col].values
+    consensus_with_worker_id_df = consensus_with_worker_id_df.sort_values(['hit_id', 'box_id'], kind='mergesort')
 
+    col_names = list(combined_consensus_results_df.columns) + ['worker_id', 'consensus_category']
+    col_names += [col for col in combined_results_df.columns if col not in col_names]
+    return consensus_with_worker_id_df.reindex(columns=col_names)
 
-def form_annotation_url(page_name, anno_dir):
+
+annotation_base_path = '/Users/schwenk/wrk/notebooks/stb/ai2-vision-turk-data/textbook-annotation-test/'
+question_categories = ['Multiple Choice',
+                       'Fill-in-the-Blank',
+                       'Short Answer',
+                       'Discussion']
+
+
+def form_annotation_url(page_name, anno_dir, base_path=annotation_base_path):
     """
     generates annotation url to match page image url.
     :param page_name:
     :param anno_dir:
+    :param base_path: root dir the annotation dirs are in
     :return:
     """
-    base_path = '/Users/schwenk/wrk/notebooks/stb/ai2-vision-turk-data/textbook-annotation-test/'    
     file_path = base_path + anno_dir
     return file_path + page_name.replace('jpeg', 'json')
 
 
-def load_local_annotation(page_name, anno_dir):
+def load_local_annotation(page_name, anno_dir, base_path=annotation_base_path, store=None):
     """
     loads annotation from disk
+    :param store: optional annotation_store.AnnotationStore to load from instead of anno_dir
     :return: annotation json
     """
-    base_path = '/Users/schwenk/wrk/notebooks/stb/ai2-vision-turk-data/textbook-annotation-test/'
-    file_path = base_path + anno_dir + page_name.replace('jpeg', 'json')
+    if store is not None:
+        return store.get_page(page_name)
+    file_path = form_annotation_url(page_name, anno_dir, base_path)
     try:
         with open(file_path, 'r') as f:
             local_annotations = json.load(f)
@@ -350,7 +836,74 @@ def load_local_annotation(page_name, anno_dir):
     return local_annotations
 
 
-def process_annotation_results(anno_page_name, boxes, unannotated_page, annotations_folder, page_schema):
+def default_file_mode():
+    """
+    :return: permissions open() gives new files under the process umask. Read once, since os.umask can only be
+    read by setting it, which isn't safe while other threads create files.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0666 & ~umask
+
+
+new_file_mode = default_file_mode()
+
+
+def write_json_atomic(file_path, data):
+    """
+    Writes json to a temp file next to file_path, then renames it into place, so an interrupted run never
+    leaves a half-written file. The file keeps the permissions of the file it replaces, or gets the ones open()
+    would give a new file (temp files are created private).
+    """
+    file_dir = os.path.dirname(file_path) or '.'
+    with tempfile.NamedTemporaryFile('wb', dir=file_dir, prefix='.tmp-', suffix='.json', delete=False) as f:
+        json.dump(data, f)
+    try:
+        file_mode = stat.S_IMODE(os.stat(file_path).st_mode)
+    except OSError:
+        file_mode = new_file_mode
+    os.chmod(f.name, file_mode)
+    os.rename(f.name, file_path)
+
+
+def apply_consensus_labels(unannotated_page, box_labels, group_n=0):
+    """
+    Updates a page annotation in place with turk labels. Question boxes get their category; text boxes labeled
+    with a question category are moved to the question boxes, with a Q id.
+    :param unannotated_page: original annotation json
+    :param box_labels: iterable of (box_id, category)
+    :param group_n: question group recorded on updated boxes
+    :return: the updated annotation
+    """
+    for box_id, category in box_labels:
+        if box_id[0] == 'Q':
+            question_box = unannotated_page['question'][box_id]
+            question_box['category'] = category
+            question_box['group_n'] = group_n
+        elif category in question_categories:
+            new_id = box_id.replace('T', 'Q')
+            question_boxes = unannotated_page.setdefault('question', {})
+            question_box = unannotated_page['text'].pop(box_id, None) or question_boxes[new_id]
+            question_box['category'] = category
+            question_box['group_n'] = group_n
+            question_box['box_id'] = new_id
+            question_boxes[new_id] = question_box
+    return unannotated_page
+
+
+def save_annotation(anno_page_name, annotation, annotations_folder, store=None):
+    """
+    Writes an updated page annotation, to annotations_folder or to an annotation store.
+    """
+    if store is not None:
+        store.put_page(anno_page_name, annotation)
+    else:
+        file_path = annotations_folder + anno_page_name.replace('jpeg', 'json').replace("\\", "")
+        write_json_atomic(file_path, annotation)
+
+
+def process_annotation_results(anno_page_name, boxes, unannotated_page, annotations_folder, page_schema,
+                               store=None):
     """
     read local annotations on disk and creates new annotation with consensus turk results
     :param anno_page_name: page name
@@ -358,58 +911,58 @@ def process_annotation_results(anno_page_name, boxes, unannotated_page, annotati
     :param unannotated_page: original annotation json
     :param annotations_folder: destination dir to be written to
     :param page_schema: page schema to validate against.
+    :param store: optional annotation_store.AnnotationStore to write to instead of annotations_folder
     """
-    question_cats = ['Multiple Choice',
-                     'Fill-in-the-Blank',
-                     'Short Answer',
-                     'Discussion']
-
-    def update_box(result_row):
-        box_id = result_row['box_id']
-        category = result_row['category']
-        # group_n = result_row['group_n'] # this change is for the simpler question annotation task
-        group_n = 0
-        if box_id[0] == 'Q':
-            annotation_type = 'question'
-            unannotated_page[annotation_type][box_id]['category'] = category
-            unannotated_page[annotation_type][box_id]['group_n'] = group_n
-        elif category in question_cats:
-            old_annotation_type = 'text'
-            new_annotation_type = 'question'
-            new_id = box_id.replace('T', 'Q')
-            unannotated_page[new_annotation_type][new_id] = unannotated_page[old_annotation_type][box_id]
-            unannotated_page[new_annotation_type][new_id]['category'] = category
-            unannotated_page[new_annotation_type][new_id]['group_n'] = group_n
-            unannotated_page[new_annotation_type][new_id]['box_id'] = new_id
-            del unannotated_page[old_annotation_type][box_id]
-            unannotated_page[annotation_type][box_id.replace('Q', 'T')]['group_n'] = group_n
-    boxes.apply(update_box, axis=1)
-    file_path = annotations_folder + anno_page_name.replace('jpeg', 'json').replace("\\", "")
-    with open(file_path, 'wb') as f:
-        json.dump(unannotated_page, f)
+    apply_consensus_labels(unannotated_page, zip(boxes['box_id'].values, boxes['category'].values))
+    save_annotation(anno_page_name, unannotated_page, annotations_folder, store)
     return
 
 
-def write_consensus_results(page_name, boxes, local_result_path, anno_dir):
+def write_consensus_results(page_name, boxes, local_result_path, anno_dir, base_path=annotation_base_path,
+                            store=None, result_store=None):
     """
     writes consensus results to disk.
     """
-    unaltered_annotations = load_local_annotation(page_name, anno_dir)
+    unaltered_annotations = load_local_annotation(page_name, anno_dir, base_path, store)
     if unaltered_annotations:
-        process_annotation_results(page_name, boxes, unaltered_annotations, local_result_path, page_schema)
+        process_annotation_results(page_name, boxes, unaltered_annotations, local_result_path, page_schema,
+                                   result_store)
 
 
-def write_results_df(aggregate_results_df, anno_dir, local_result_dir='newly-labeled-annotations/'):
+@instrumented(rows_in='aggregate_results_df')
+def write_results_df(aggregate_results_df, anno_dir, local_result_dir='newly-labeled-annotations/',
+                     base_path=annotation_base_path, result_base_path=None, max_workers=8, store=None,
+                     result_store=None):
     """
     writes new annotation json to disk from a results dataframe
+    Box labels are grouped by page in a single pass, then each page's annotation is read, updated and atomically
+    rewritten from a pool of threads.
     :param aggregate_results_df: dataframe to write
-    :param anno_dir: destination dir
-    :param local_result_dir: local original annotations to add to
-    """
-    base_path = '/Users/schwenk/wrk/notebooks/stb/ai2-vision-turk-data/textbook-annotation-test/'    
-    local_result_path = base_path + local_result_dir
-    for page, boxes in aggregate_results_df.groupby('page'):
-        write_consensus_results(page, boxes, local_result_path, anno_dir)
+    :param anno_dir: dir of the original annotations to add to
+    :param local_result_dir: destination dir
+    :param base_path: root dir anno_dir is in
+    :param result_base_path: root dir local_result_dir is in, defaults to base_path
+    :param max_workers: pages read and written concurrently
+    :param store: optional annotation_store.AnnotationStore to read original annotations from instead of anno_dir
+    :param result_store: optional annotation_store.AnnotationStore to write to instead of local_result_dir
+    :return: number of annotation files written
+    """
+    local_result_path = (result_base_path or base_path) + local_result_dir
+    box_labels_by_page = defaultdict(list)
+    for page, box_id, category in zip(aggregate_results_df['page'].values, aggregate_results_df['box_id'].values,
+                                      aggregate_results_df['category'].values):
+        box_labels_by_page[page].append((box_id, category))
+
+    def write_page(page_labels):
+        page, box_labels = page_labels
+        unaltered_annotations = load_local_annotation(page, anno_dir, base_path, store)
+        if not unaltered_annotations:
+            return 0
+        apply_consensus_labels(unaltered_annotations, box_labels)
+        save_annotation(page, unaltered_annotations, local_result_path, result_store)
+        return 1
+
+    return sum(map_with_pool(write_page, sorted(box_labels_by_page.items()), max_workers))
 
 
 def review_results(pages_to_review, annotation_dir='newly-labeled-annotations/'):
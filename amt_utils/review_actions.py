@@ -0,0 +1,184 @@
+import sqlite3
+import threading
+import time
+from collections import Counter, defaultdict
+from multiprocessing.pool import ThreadPool
+
+from boto.mturk.connection import MTurkRequestError
+
+from throttling import TokenBucket, call_with_retry, is_throttling_error
+
+"""
+Bulk review actions (approving and rejecting assignments, blocking workers, disabling HITs), run concurrently under
+a rate limit. Finished operations are recorded in a journal, so a crashed or interrupted run can be repeated without
+acting twice.
+"""
+
+default_reject_feedback = """
+    Your HITs contained many incomplete or incorrect pages.
+    """
+default_block_reason = """
+        Worker's submissions were largely incomplete.
+        """
+# mturk errors meaning the operation can never succeed, e.g. approving an assignment that was already rejected
+conflict_codes = ['InvalidAssignmentState', 'InvalidHITState', 'DoesNotExist']
+
+
+def approve_operations(assignments_by_hit):
+    """
+    :param assignments_by_hit: hit_id: [boto assignment] dict, as returned by process_hits.get_assignments
+    :return: approve operations for the submitted assignments
+    """
+    return [('approve', assignment.AssignmentId, None)
+            for hit_assignments in assignments_by_hit.values() for assignment in hit_assignments
+            if assignment.AssignmentStatus == 'Submitted']
+
+
+def reject_operations(assignment_ids, feedback=default_reject_feedback):
+    return [('reject', assignment_id, feedback) for assignment_id in assignment_ids]
+
+
+def block_operations(worker_ids, reason=default_block_reason):
+    return [('block', worker_id, reason) for worker_id in worker_ids]
+
+
+def disable_operations(hit_ids):
+    return [('disable', hit_id, None) for hit_id in hit_ids]
+
+
+def perform_operation(mturk_connection, operation):
+    """
+    Makes the mturk request for a single operation.
+    :param operation: (action, target, message) tuple. action is one of approve, reject (target is an assignment id),
+    block (a worker id) or disable (a hit id); message is the feedback or block reason.
+    """
+    action, target, message = operation
+    if action == 'approve':
+        mturk_connection.approve_assignment(target, message)
+    elif action == 'reject':
+        mturk_connection.reject_assignment(target, message)
+    elif action == 'block':
+        mturk_connection.block_worker(target, message)
+    elif action == 'disable':
+        mturk_connection.disable_hit(target)
+    else:
+        raise ValueError('unknown review action: ' + str(action))
+
+
+def is_conflict(error):
+    return isinstance(error, MTurkRequestError) and any(code in str(error.body) for code in conflict_codes)
+
+
+class OperationJournal(object):
+    """
+    SQLite record of finished review operations, keyed by (action, target). Safe to share between threads.
+    Succeeded and conflicting operations are final; failed ones are retried by the next run.
+    """
+    def __init__(self, db_path):
+        """
+        :param db_path: sqlite database file, created if it doesn't exist
+        """
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS operations (
+                action TEXT,
+                target TEXT,
+                outcome TEXT,
+                error TEXT,
+                finished_at REAL,
+                PRIMARY KEY (action, target)
+            );
+        """)
+
+    def close(self):
+        self.connection.close()
+
+    def finished(self):
+        """
+        :return: set of (action, target) that need no further attempts
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT action, target FROM operations WHERE outcome != 'failed'")
+            return set(rows.fetchall())
+
+    def record(self, action, target, outcome, error=None):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO operations VALUES (?, ?, ?, ?, ?)',
+                                    (action, target, outcome, error, time.time()))
+
+    def outcomes(self):
+        """
+        :return: (action, target): outcome dict of every journaled operation
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT action, target, outcome FROM operations').fetchall()
+        return {(action, target): outcome for action, target, outcome in rows}
+
+
+def run_review_operations(mturk_connection, operations, journal=None, max_workers=4, max_per_second=None,
+                          max_retries=3):
+    """
+    Runs review operations concurrently. Only throttled requests are retried, with backoff: the review actions
+    aren't idempotent, so retrying one that failed after mturk had already applied it would come back as a conflict.
+    Any other error fails the operation; with a journal, the next run tries it again.
+    :param mturk_connection: active mturk connection established by user in the nb.
+    :param operations: list of (action, target, message), see perform_operation and the *_operations functions
+    :param journal: optional OperationJournal. Operations it lists as finished are skipped and every outcome is
+    recorded in it.
+    :param max_workers: requests in flight at once
+    :param max_per_second: optional cap on the request rate, shared by all workers
+    :param max_retries: retries per throttled operation after the first attempt
+    :return: summary dict with counts per outcome (succeeded, conflict, failed, skipped), counts per action and
+    outcome, the failed and conflicting operations with their errors, and elapsed time
+    """
+    start_time = time.time()
+    finished = journal.finished() if journal else set()
+    seen = set()
+    to_run = []
+    for operation in operations:
+        key = operation[:2]
+        if key not in finished and key not in seen:
+            to_run.append(operation)
+        seen.add(key)
+    rate_limiter = TokenBucket(max_per_second) if max_per_second else None
+
+    def run_operation(operation):
+        action, target, _ = operation
+        try:
+            call_with_retry(perform_operation, (mturk_connection, operation), max_retries=max_retries,
+                            rate_limiter=rate_limiter, is_retryable=is_throttling_error)
+            outcome, error = 'succeeded', None
+        except Exception as e:
+            outcome, error = ('conflict' if is_conflict(e) else 'failed'), repr(e)
+        if journal:
+            journal.record(action, target, outcome, error)
+        return action, target, outcome, error
+
+    pool = ThreadPool(max(1, min(max_workers, len(to_run))))
+    try:
+        results = pool.map(run_operation, to_run)
+    finally:
+        pool.close()
+        pool.join()
+
+    by_action = defaultdict(Counter)
+    errors = defaultdict(list)
+    for action, target, outcome, error in results:
+        by_action[action][outcome] += 1
+        if error:
+            errors[outcome].append((action, target, error))
+    outcome_counts = Counter(outcome for _, _, outcome, _ in results)
+    elapsed = time.time() - start_time
+    return {
+        'succeeded': outcome_counts['succeeded'],
+        'conflict': outcome_counts['conflict'],
+        'failed': outcome_counts['failed'],
+        'skipped': len(seen & finished),
+        'by_action': {action: dict(counts) for action, counts in by_action.items()},
+        'conflicts': errors['conflict'],
+        'failures': errors['failed'],
+        'elapsed_seconds': elapsed,
+        'operations_per_second': len(results) / elapsed if elapsed else 0.0
+    }
@@ -0,0 +1,84 @@
+import json
+import random
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+"""
+A local stand-in for the vision-ocr service, for exercising ocr_pipeline without network access.
+POSTs to any path return a few canned detections, after the configured latency, or fail with a 503.
+"""
+
+
+def make_detections(n_boxes):
+    return [{
+        'value': 'word ' + str(box_n),
+        'score': 0.9,
+        'rectangle': [{'x': 10, 'y': 20 * box_n}, {'x': 110, 'y': 20 * box_n + 15}]
+    } for box_n in range(n_boxes)]
+
+
+class StubOCRServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, failure_rate=0.0, n_boxes=5, seed=None):
+        """
+        :param port: port to listen on, 0 picks a free one
+        :param latency: seconds each request takes
+        :param failure_rate: chance any single request fails with a 503
+        :param n_boxes: detections returned per page
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', port), StubOCRHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.n_boxes = n_boxes
+        self.rng = random.Random(seed)
+        self.requests_received = 0
+        self.requests_failed = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:' + str(self.server_address[1]) + '/v1/ocr'
+
+    def start(self):
+        """
+        Serves requests from a daemon thread.
+        :return: the server, for chaining
+        """
+        server_thread = threading.Thread(target=self.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubOCRHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        request_data = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+        server = self.server
+        with server.lock:
+            server.requests_received += 1
+            failed = server.rng.random() < server.failure_rate
+            if failed:
+                server.requests_failed += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if failed:
+            self.send_response(503)
+            self.end_headers()
+            return
+        body = json.dumps({'url': request_data.get('url'), 'detections': make_detections(server.n_boxes)})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,119 @@
+import random
+import socket
+import threading
+import time
+from httplib import HTTPException
+
+import requests
+from boto.exception import BotoServerError
+
+from instrumentation import record_request
+
+"""
+Rate limiting and retry helpers shared by the functions that make many mechanical turk (or OCR service) requests.
+"""
+
+retryable_statuses = [429, 500, 502, 503, 504]
+throttling_codes = ['AWS.ServiceUnavailable', 'ServiceUnavailable', 'Throttling', 'RequestLimitExceeded']
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket. Each request takes one token; tokens refill at a fixed rate up to a burst capacity.
+    """
+    def __init__(self, rate, capacity=None, clock=time.time, sleep=time.sleep):
+        """
+        :param rate: tokens added per second (the sustained requests per second)
+        :param capacity: largest burst allowed, defaults to one second's worth of tokens
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate))
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.last_refill = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available, then takes it.
+        :return: seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait_time = (1 - self.tokens) / self.rate
+            self.sleep(wait_time)
+            waited += wait_time
+
+
+def is_throttling_error(error):
+    """
+    Decides whether a failed request was refused for exceeding the rate limit, so it never took effect and is
+    safe to retry even for requests that aren't idempotent.
+    :param error: exception raised by the request (boto or requests)
+    :return: bool
+    """
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code == 429
+    if isinstance(error, BotoServerError):
+        error_text = (error.error_code or '') + str(error.body)
+        return any(code in error_text for code in throttling_codes)
+    return False
+
+
+def is_transient_error(error):
+    """
+    Decides whether a failed request is worth retrying: throttling, server-side errors and dropped connections.
+    :param error: exception raised by the request (boto or requests)
+    :return: bool
+    """
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code in retryable_statuses
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, BotoServerError):
+        if error.status in retryable_statuses:
+            return True
+        error_text = (error.error_code or '') + str(error.body)
+        return any(code in error_text for code in throttling_codes)
+    return isinstance(error, (socket.error, HTTPException))
+
+
+def call_with_retry(func, args=(), kwargs=None, max_retries=3, base_delay=1.0, max_delay=30.0,
+                    rate_limiter=None, is_retryable=is_transient_error, sleep=time.sleep):
+    """
+    Calls func, retrying retryable errors with jittered exponential backoff.
+    :param func: function making the request
+    :param max_retries: retries after the first attempt
+    :param base_delay: backoff before the first retry, in seconds; doubled on each retry
+    :param max_delay: largest backoff
+    :param rate_limiter: optional TokenBucket acquired before every attempt
+    :param is_retryable: decides which exceptions are retried
+    Every attempt's latency is recorded under func's name when instrumentation is enabled.
+    :return: func's return value. The last exception is re-raised when retries run out.
+    """
+    kwargs = kwargs or {}
+    operation = getattr(func, '__name__', 'request')
+    attempt = 0
+    while True:
+        if rate_limiter:
+            rate_limiter.acquire()
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+            record_request(operation, time.time() - start)
+            return result
+        except Exception as e:
+            record_request(operation, time.time() - start, failed=True)
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            delay = min(max_delay, base_delay * 2 ** attempt)
+            sleep(delay / 2 + random.uniform(0, delay / 2))
+            attempt += 1
@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+
+import process_hits
+
+"""
+Worker quality scoring from harvested results, to pick the workers to pass to process_hits.reject_assignments and
+process_hits.ban_bad_workers. Everything is computed with vectorized counts over integer-coded votes.
+"""
+
+score_columns = ['n_votes', 'n_assignments', 'n_scored', 'agreement', 'unlabeled_rate', 'reliability',
+                 'recommendation']
+
+
+def worker_reliability(results_df):
+    """
+    Estimates each worker's reliability with a one-coin Dawid-Skene model fit over the whole batch.
+    :param results_df: results dataframe, see process_hits.make_results_df
+    :return: series of estimated accuracy, indexed by worker_id
+    """
+    group_codes, group_pages, _ = process_hits.group_box_votes(results_df)
+    worker_codes, workers = pd.factorize(results_df['worker_id'])
+    label_codes, labels = pd.factorize(results_df['category'])
+    accuracy, _, _ = process_hits.estimate_worker_reliability(group_codes, worker_codes, label_codes,
+                                                              len(group_pages), len(workers), len(labels))
+    return pd.Series(accuracy, index=pd.Index(np.asarray(workers), name='worker_id'))
+
+
+def category_confusion(consensus_with_worker_df, no_consensus_flag='No Consensus'):
+    """
+    Counts each worker's labels against the consensus label, for boxes that reached consensus.
+    :param consensus_with_worker_df: see process_hits.make_consensus_df_w_worker_id
+    :return: dataframe with worker_id, consensus_category, category and count columns
+    """
+    consensus_categories = np.asarray(consensus_with_worker_df['consensus_category'], dtype=object)
+    scored = consensus_with_worker_df[consensus_categories != no_consensus_flag]
+    confusion = pd.DataFrame({
+        'worker_id': np.asarray(scored['worker_id'], dtype=object),
+        'consensus_category': np.asarray(scored['consensus_category'], dtype=object),
+        'category': np.asarray(scored['category'], dtype=object)
+    })
+    return confusion.groupby(['worker_id', 'consensus_category', 'category']).size().rename('count').reset_index()
+
+
+def score_workers(results_df, consensus_with_worker_df, no_consensus_flag='No Consensus',
+                  unlabeled_category='unlabeled', min_votes=20, reject_below=0.6, block_below=0.4):
+    """
+    Scores every worker and recommends reject/block candidates.
+    :param results_df: results dataframe, see process_hits.make_results_df
+    :param consensus_with_worker_df: see process_hits.make_consensus_df_w_worker_id
+    :param no_consensus_flag: consensus value of tied boxes, which don't count towards agreement
+    :param unlabeled_category: category of boxes a worker left unlabeled
+    :param min_votes: workers with fewer votes are never recommended for rejection
+    :param reject_below: recommend rejecting workers whose reliability is below this
+    :param block_below: recommend blocking workers whose reliability is below this
+    :return: dataframe indexed by worker_id, worst workers first, with columns:
+    n_votes, n_assignments, n_scored (votes on boxes with consensus), agreement (with consensus),
+    unlabeled_rate, reliability (Dawid-Skene accuracy estimate) and recommendation ('block', 'reject' or 'ok')
+    """
+    worker_codes, workers = pd.factorize(results_df['worker_id'])
+    n_workers = len(workers)
+    n_votes = np.bincount(worker_codes, minlength=n_workers)
+    unlabeled = np.asarray(results_df['category'], dtype=object) == unlabeled_category
+    unlabeled_rate = np.bincount(worker_codes, weights=unlabeled, minlength=n_workers) / np.maximum(n_votes, 1)
+    assignment_codes, assignment_ids = pd.factorize(results_df['assignment_id'])
+    assignment_workers = np.zeros(len(assignment_ids), dtype=np.int64)
+    assignment_workers[assignment_codes] = worker_codes
+    n_assignments = np.bincount(assignment_workers, minlength=n_workers)
+
+    worker_index = pd.Index(np.asarray(workers), name='worker_id')
+    consensus_categories = np.asarray(consensus_with_worker_df['consensus_category'], dtype=object)
+    scored = consensus_categories != no_consensus_flag
+    scored_worker_codes = worker_index.get_indexer(np.asarray(consensus_with_worker_df['worker_id'], dtype=object))
+    scored &= scored_worker_codes >= 0
+    agrees = np.asarray(consensus_with_worker_df['category'], dtype=object) == consensus_categories
+    n_scored = np.bincount(scored_worker_codes[scored], minlength=n_workers)
+    n_agree = np.bincount(scored_worker_codes[scored & agrees], minlength=n_workers)
+
+    scores = pd.DataFrame({
+        'n_votes': n_votes,
+        'n_assignments': n_assignments,
+        'n_scored': n_scored,
+        'agreement': n_agree / np.maximum(n_scored, 1).astype(float),
+        'unlabeled_rate': unlabeled_rate,
+        'reliability': worker_reliability(results_df).reindex(worker_index).values
+    }, index=worker_index)
+    eligible = scores['n_votes'] >= min_votes
+    scores['recommendation'] = np.where(eligible & (scores['reliability'] < block_below), 'block',
+                                        np.where(eligible & (scores['reliability'] < reject_below), 'reject', 'ok'))
+    return scores[score_columns].sort_values(['reliability', 'agreement'])
+
+
+def rank_bad_workers(scores):
+    """
+    :param scores: see score_workers
+    :return: (workers to reject, workers to block) lists, worst first
+    """
+    flagged = scores[scores['recommendation'] != 'ok']
+    return flagged.index.tolist(), flagged[flagged['recommendation'] == 'block'].index.tolist()
+
+
+def score_harvest(results_df, no_consensus_flag='No Consensus', **score_params):
+    """
+    Runs consensus and worker scoring on a freshly harvested results dataframe.
+    :param results_df: results dataframe, see process_hits.make_results_df
+    :param score_params: passed to score_workers
+    :return: worker scores, per-worker category confusion counts
+    """
+    consensus_df = process_hits.make_consensus_df(results_df, no_consensus_flag)
+    consensus_with_worker_df = process_hits.make_consensus_df_w_worker_id(results_df, consensus_df)
+    scores = score_workers(results_df, consensus_with_worker_df, no_consensus_flag, **score_params)
+    return scores, category_confusion(consensus_with_worker_df, no_consensus_flag)
@@ -0,0 +1,41 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'amt_utils'))
+
+import fake_mturk
+import process_hits
+from checkpoint_store import CheckpointStore
+
+
+class HarvestNewResultsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.store = CheckpointStore(os.path.join(self.db_dir, 'checkpoint.db'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.db_dir)
+
+    def test_resubmitted_assignment_without_boxes_replaces_old_rows(self):
+        connection = fake_mturk.FakeMTurkConnection()
+        url = process_hits.form_hit_url('test_book.pdf', 0)
+        hit_params = {'title': 'Label text boxes', 'description': 'Test HIT', 'keywords': 'test', 'amount': 0.10,
+                      'frame_height': 800, 'max_assignments': 1, 'duration': 3600, 'lifetime': 86400}
+        hit_id = process_hits.create_hits_from_pages(connection, [url], hit_params)[url]
+        boxes = [{'id': 'T1', 'category': 'definition', 'group_n': 0}]
+        assignment = connection.add_assignment(hit_id, 'W1', 'test_book_0.jpeg', boxes)
+        self.assertEqual(len(process_hits.harvest_new_results(connection, self.store)), 1)
+
+        assignment.answers = fake_mturk.FakeAssignment(assignment.AssignmentId, hit_id, 'W1', 'test_book_0.jpeg',
+                                                       []).answers
+        self.assertEqual(len(process_hits.harvest_new_results(connection, self.store)), 0)
+        self.assertEqual(len(self.store.load_results()), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
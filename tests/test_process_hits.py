@@ -0,0 +1,61 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'amt_utils'))
+
+import benchmarks
+import process_hits
+
+"""
+Regression tests for process_hits, run with python -m unittest discover tests
+"""
+
+
+class ConsensusWithWorkerIdTest(unittest.TestCase):
+
+    def setUp(self):
+        raw_hit_results = benchmarks.make_synthetic_hit_results(3000)
+        self.results_df = process_hits.make_question_results_df(raw_hit_results, categorical=False)
+
+    def test_matches_legacy_implementation(self):
+        consensus_df = process_hits.make_consensus_df(self.results_df, 'No Consensus')
+        expected = benchmarks.legacy_make_consensus_df_w_worker_id(self.results_df, consensus_df)
+        actual = process_hits.make_consensus_df_w_worker_id(self.results_df, consensus_df)
+        self.assertEqual(len(actual), len(self.results_df))
+        compared_cols = list(self.results_df.columns) + ['consensus_category']
+        pd.testing.assert_frame_equal(actual[compared_cols], expected[compared_cols], check_dtype=False)
+
+    def test_carries_box_stats(self):
+        for method, params in [('majority', {}), ('weighted', {'include_posteriors': True})]:
+            consensus_df = process_hits.make_consensus_df(self.results_df, 'No Consensus', method=method, **params)
+            actual = process_hits.make_consensus_df_w_worker_id(self.results_df, consensus_df)
+            stat_cols = [col for col in consensus_df.columns if col not in self.results_df.columns]
+            self.assertIn('vote_count', stat_cols)
+            self.assertEqual(actual.columns[:len(consensus_df.columns)].tolist(), list(consensus_df.columns))
+            self.assertFalse(actual[stat_cols].isnull().any().any())
+
+            expected = consensus_df.set_index(['hit_id', 'box_id'])
+            box_keys = list(zip(actual['hit_id'], actual['box_id']))
+            for col in stat_cols:
+                np.testing.assert_array_equal(actual[col].values, expected[col].reindex(box_keys).values)
+            np.testing.assert_array_equal(actual['consensus_category'].values,
+                                          expected['category'].reindex(box_keys).values)
+
+
+class EmptyConsensusTest(unittest.TestCase):
+
+    def test_empty_results(self):
+        results_df = process_hits.make_results_df_from_assignments({}, include_group_n=True)
+        majority_df = process_hits.make_consensus_df(results_df, 'No Consensus')
+        weighted_df = process_hits.make_consensus_df(results_df, 'No Consensus', method='weighted')
+        self.assertEqual(len(majority_df), 0)
+        self.assertEqual(len(weighted_df), 0)
+        self.assertEqual(list(weighted_df.columns), list(majority_df.columns) + ['confidence'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import os
+import socket
+import sys
+import unittest
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'amt_utils'))
+
+import adaptive_allocation
+import fake_mturk
+import process_hits
+from boto.mturk.connection import MTurkRequestError
+from review_actions import reject_operations, run_review_operations
+from throttling import is_throttling_error
+
+hit_params = {
+    'title': 'Label text boxes',
+    'description': 'Test HIT',
+    'keywords': 'test',
+    'amount': 0.10,
+    'frame_height': 800,
+    'max_assignments': 3,
+    'duration': 3600,
+    'lifetime': 86400
+}
+
+
+class FlakyConnection(fake_mturk.FakeMTurkConnection):
+    """
+    Fails the first create_hit request with the given error, before or after the HIT is created.
+    """
+    def __init__(self, error, created_first):
+        fake_mturk.FakeMTurkConnection.__init__(self)
+        self.error = error
+        self.created_first = created_first
+
+    def create_hit(self, **hit_params):
+        error, self.error = self.error, None
+        if error and not self.created_first:
+            raise error
+        created = fake_mturk.FakeMTurkConnection.create_hit(self, **hit_params)
+        if error:
+            raise error
+        return created
+
+
+class CreateHitRetryTest(unittest.TestCase):
+
+    def create_hit(self, error, created_first):
+        connection = FlakyConnection(error, created_first)
+        url = process_hits.form_hit_url('test_book.pdf', 0)
+        created = process_hits.create_hits_from_pages(connection, [url], hit_params, max_retries=3)
+        return connection, created[url]
+
+    def test_throttled_create_is_retried(self):
+        error = MTurkRequestError(503, 'Service Unavailable', fake_mturk.throttled_body)
+        self.assertTrue(is_throttling_error(error))
+        connection, result = self.create_hit(error, created_first=False)
+        self.assertEqual(connection.hits.keys(), [result])
+
+    def test_failed_create_is_not_reposted(self):
+        for error in [socket.timeout('timed out'), MTurkRequestError(500, 'Internal Server Error', '')]:
+            self.assertFalse(is_throttling_error(error))
+            connection, result = self.create_hit(error, created_first=True)
+            self.assertIs(result, error)
+            self.assertEqual(len(connection.hits), 1)
+
+
+class ExtendHitRetryTest(unittest.TestCase):
+
+    def test_failed_extend_is_not_repeated(self):
+        connection = fake_mturk.FakeMTurkConnection()
+        url = process_hits.form_hit_url('test_book.pdf', 0)
+        hit_id = process_hits.create_hits_from_pages(connection, [url], hit_params)[url]
+        extend_hit = connection.extend_hit
+        error = socket.timeout('timed out')
+
+        def extend_then_time_out(*args, **kwargs):
+            extend_hit(*args, **kwargs)
+            raise error
+
+        connection.extend_hit = extend_then_time_out
+        extended = adaptive_allocation.extend_hits(connection, {hit_id: 1}, max_retries=3)
+        self.assertIs(extended[hit_id], error)
+        self.assertEqual(connection.hits[hit_id].params['max_assignments'], hit_params['max_assignments'] + 1)
+
+
+class SimulateAllocationTest(unittest.TestCase):
+
+    def test_stops_when_extensions_keep_failing(self):
+        extend_hits = adaptive_allocation.extend_hits
+
+        def failing_extend_hits(mturk_connection, extensions, **extend_params):
+            return {hit_id: socket.timeout('timed out') for hit_id in extensions}
+
+        adaptive_allocation.extend_hits = failing_extend_hits
+        try:
+            outcome = adaptive_allocation.simulate_allocation(n_pages=20, min_agreement=1.0)
+        finally:
+            adaptive_allocation.extend_hits = extend_hits
+        self.assertEqual(outcome['rounds'], 1)
+        self.assertEqual(outcome['assignments_per_page'], 2)
+
+    def test_rounds_are_capped(self):
+        outcome = adaptive_allocation.simulate_allocation(n_pages=20, min_agreement=1.0, max_assignments=50,
+                                                          max_rounds=2)
+        self.assertEqual(outcome['rounds'], 3)
+
+
+class ReviewRetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = fake_mturk.FakeMTurkConnection()
+        url = process_hits.form_hit_url('test_book.pdf', 0)
+        hit_id = process_hits.create_hits_from_pages(self.connection, [url], hit_params)[url]
+        self.assignment = self.connection.add_assignment(hit_id, 'W1', 'test_book_0.jpeg', [])
+        self.worker_result_df = pd.DataFrame({'worker_id': ['W1'], 'assignment_id': [self.assignment.AssignmentId]})
+
+    def fail_rejects_with(self, error, applied_first):
+        reject_assignment = self.connection.reject_assignment
+        self.calls = []
+
+        def flaky_reject(*args, **kwargs):
+            self.calls.append(args)
+            if len(self.calls) == 1:
+                if applied_first:
+                    reject_assignment(*args, **kwargs)
+                raise error
+            return reject_assignment(*args, **kwargs)
+
+        self.connection.reject_assignment = flaky_reject
+
+    def test_throttled_reject_is_retried(self):
+        self.fail_rejects_with(MTurkRequestError(503, 'Service Unavailable', fake_mturk.throttled_body), False)
+        summary = run_review_operations(self.connection, reject_operations([self.assignment.AssignmentId]))
+        self.assertEqual(summary['succeeded'], 1)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.assignment.AssignmentStatus, 'Rejected')
+
+    def test_failed_reject_is_not_repeated(self):
+        error = socket.timeout('timed out')
+        self.fail_rejects_with(error, True)
+        summary = run_review_operations(self.connection, reject_operations([self.assignment.AssignmentId]))
+        self.assertEqual((summary['failed'], summary['conflict']), (1, 0))
+        self.assertEqual(len(self.calls), 1)
+
+    def test_reject_assignments_raises_on_failures(self):
+        self.fail_rejects_with(socket.timeout('timed out'), False)
+        with self.assertRaises(RuntimeError):
+            process_hits.reject_assignments(self.connection, ['W1'], self.worker_result_df)
+        self.assertEqual(process_hits.reject_assignments(self.connection, ['W1'], self.worker_result_df), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()